@@ -1,19 +1,39 @@
 import os
 import io
 import uuid
-from flask import Flask, request, render_template, jsonify, send_file, flash, redirect, url_for
+from flask import Flask, Response, request, render_template, jsonify, send_file, flash, redirect, url_for
 from werkzeug.utils import secure_filename
 import google.generativeai as genai
 from PIL import Image
 import pytesseract
 import PyPDF2
 import pandas as pd
+import numpy as np
+from openpyxl import load_workbook
 import spacy
+from spacy.lang.en.stop_words import STOP_WORDS
 from datetime import datetime
 import json
 import re
+import math
+import shutil
+import contextlib
+import hashlib
+import difflib
+import threading
+import time
+import queue
+from collections import deque
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 # Load environment variables
 load_dotenv()
 
@@ -29,19 +49,98 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Prompt compaction settings
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000'))
+BOILERPLATE_MIN_SHARE = float(os.getenv('BOILERPLATE_MIN_SHARE', '0.6'))
+BOILERPLATE_MIN_SUBMISSIONS = int(os.getenv('BOILERPLATE_MIN_SUBMISSIONS', '5'))
+
+# Near-duplicate detection settings
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.8'))
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bands of 4 rows: ~0.5 similarity catches most pairs above 0.8
+SHINGLE_SIZE = 3
+CROSS_SESSION_DUPLICATES = os.getenv('CROSS_SESSION_DUPLICATES', 'false').lower() == 'true'
+MINHASH_INDEX_PATH = os.path.join(RESULTS_FOLDER, 'minhash_index.jsonl')
+MINHASH_INDEX_LOCK_PATH = os.path.join(RESULTS_FOLDER, 'minhash_index.lock')
+
+# Per-session state kept alongside the uploads so late submissions can be
+# graded without redoing the rest of the class
+SESSION_STATE_FILE = 'session.json'
+SESSION_LOCK_FILE = '.lock'
+
+# Gemini deadline and circuit breaker settings (seconds unless noted)
+GEMINI_CALL_TIMEOUT = float(os.getenv('GEMINI_CALL_TIMEOUT', '30'))
+GEMINI_SLOW_CALL_SECONDS = float(os.getenv('GEMINI_SLOW_CALL_SECONDS', '15'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))  # consecutive slow/failed calls
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '60'))
+REGRADE_MAX_ATTEMPTS = 5
+REGRADE_CLAIM_SECONDS = 300  # a claim older than this is from a process that died mid-regrade
+
+# Concurrency settings: number of worker processes for CPU-heavy PDF parsing
+# and spaCy work (0 runs it in the calling thread)
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', '0'))
+
+# Storage retention: uploaded files expire first, a session's saved state
+# and reports together later, and the oldest sessions and question papers
+# are evicted early when the total goes over quota
+UPLOAD_TTL_HOURS = float(os.getenv('UPLOAD_TTL_HOURS', '72'))
+REPORT_TTL_HOURS = float(os.getenv('REPORT_TTL_HOURS', '720'))
+QUESTION_BANK_TTL_HOURS = float(os.getenv('QUESTION_BANK_TTL_HOURS', '720'))
+STORAGE_QUOTA_MB = float(os.getenv('STORAGE_QUOTA_MB', '2048'))
+STORAGE_JANITOR_INTERVAL = float(os.getenv('STORAGE_JANITOR_INTERVAL', '600'))
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, '_blobs')
+BLOB_GRACE_SECONDS = 3600
+UPLOAD_FILE_PREFIXES = ('question_', 'answer_')
+REPORT_NAME_PATTERN = re.compile(r'^evaluation_report_([0-9a-f-]{36})_\d{8}_\d{6}\.xlsx$')
+
+# Question and reference-answer bank
+QUESTION_BANK_FOLDER = os.getenv('QUESTION_BANK_FOLDER', 'question_bank')
+QUESTION_BANK_MATCH_THRESHOLD = float(os.getenv('QUESTION_BANK_MATCH_THRESHOLD', '0.9'))
+
+# Rubric matcher settings
+RUBRIC_MAX_REFERENCE_POINTS = 50
+RUBRIC_CACHE_SIZE = 64
+
+# Fair scheduler settings for shared Gemini and OCR capacity
+# Each worker thread holds one OCR job or Gemini call, so by default a process
+# can run as many as gunicorn serves requests (see gunicorn.conf.py)
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', os.getenv('GUNICORN_THREADS', '32')))
+SCHEDULER_QUEUE_LIMIT = int(os.getenv('SCHEDULER_QUEUE_LIMIT', '2000'))
+SCHEDULER_TENANT_QUEUE_LIMIT = int(os.getenv('SCHEDULER_TENANT_QUEUE_LIMIT', '600'))
+INTERACTIVE_MAX_FILES = int(os.getenv('INTERACTIVE_MAX_FILES', '10'))
+LANE_WEIGHTS = {'interactive': 4, 'bulk': 1}
+
+def parse_tenant_weights(value):
+    """Parse "tenant:weight,..." into a dict, rejecting weights that are not positive"""
+    weights = {}
+    for item in value.split(','):
+        if ':' not in item:
+            continue
+        name, weight = item.rsplit(':', 1)
+        weight = float(weight)
+        if not (weight > 0 and math.isfinite(weight)):
+            raise ValueError(f"TENANT_WEIGHTS entry for '{name.strip()}' must be a positive number, got {weight}")
+        weights[name.strip().lower()] = weight
+    return weights
+
+# Optional per-tenant weights, e.g. "physics-101:2,cs-201:1"
+TENANT_WEIGHTS = parse_tenant_weights(os.getenv('TENANT_WEIGHTS', ''))
+
 # Ensure upload and results folders exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
+os.makedirs(QUESTION_BANK_FOLDER, exist_ok=True)
 
 # Configure Gemini AI
 api_key = os.getenv('GEMINI_API_KEY')
+# Use the stable working model (Gemini 2.0 Flash)
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
 if api_key and api_key != 'your_gemini_api_key_here':
     try:
         genai.configure(api_key=api_key)
-        # Use the stable working model (Gemini 2.0 Flash)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        vision_model = genai.GenerativeModel('gemini-2.0-flash')
-        print("✅ Gemini AI configured successfully with gemini-2.0-flash")
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        vision_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        print(f"✅ Gemini AI configured successfully with {GEMINI_MODEL_NAME}")
     except Exception as e:
         print(f"❌ Gemini AI configuration failed: {e}")
         print("💡 Please check your API key in .env file")
@@ -83,6 +182,60 @@ except OSError:
     print("Warning: spaCy model 'en_core_web_sm' not found. Please install it with: python -m spacy download en_core_web_sm")
     nlp = None
 
+# Module globals shared by request threads: ``model`` only records whether
+# Gemini is configured (each thread gets its own client), and spaCy calls go
+# through nlp_vector() so only one thread uses the pipeline at a time
+gemini_local = threading.local()
+nlp_lock = threading.Lock()
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path, shared by all server processes"""
+    with open(path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def get_gemini_model():
+    """Return this thread's Gemini client"""
+    if not hasattr(gemini_local, 'model'):
+        gemini_local.model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return gemini_local.model
+
+def nlp_vector(text):
+    """Return the spaCy document vector for text"""
+    with nlp_lock:
+        return nlp(text).vector
+
+cpu_executor = None
+cpu_executor_lock = threading.Lock()
+
+def run_cpu_bound(fn, *args):
+    """Run CPU-heavy work in the process pool when CPU_WORKERS is set.
+
+    Request threads then only wait on I/O, so one server process can hold
+    many concurrent gradings without them fighting over the GIL. The pool
+    uses spawn so it is safe to start from a threaded server.
+    """
+    global cpu_executor
+    if CPU_WORKERS <= 0:
+        return fn(*args)
+    with cpu_executor_lock:
+        if cpu_executor is None:
+            cpu_executor = ProcessPoolExecutor(max_workers=CPU_WORKERS,
+                                               mp_context=multiprocessing.get_context('spawn'))
+    return cpu_executor.submit(fn, *args).result()
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -150,7 +303,7 @@ def extract_text_from_file(file_path):
     file_extension = file_path.rsplit('.', 1)[1].lower()
     
     if file_extension == 'pdf':
-        return extract_text_from_pdf(file_path)
+        return run_cpu_bound(extract_text_from_pdf, file_path)
     elif file_extension in ['png', 'jpg', 'jpeg', 'gif']:
         return extract_text_from_image(file_path)
     elif file_extension == 'txt':
@@ -159,17 +312,7 @@ def extract_text_from_file(file_path):
     else:
         return ""
 
-def analyze_answer_with_gemini(question, correct_answer, student_answer):
-    """Analyze student answer using Gemini AI"""
-    if not model:
-        return {
-            'score': 0,
-            'feedback': 'AI model not available',
-            'details': 'Gemini AI is not properly configured'
-        }
-    
-    try:
-        prompt = f"""
+PROMPT_TEMPLATE = """
         As an expert teacher, evaluate the following student answer:
         
         Question: {question}
@@ -185,55 +328,459 @@ def analyze_answer_with_gemini(question, correct_answer, student_answer):
         
         Format your response as JSON with keys: score, feedback, suggestions
         """
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    """Estimate the token count of text without a network round-trip.
+
+    Words and punctuation marks are counted separately and long words are
+    charged one extra token per 4 characters, which tracks Gemini's tokenizer
+    closely enough for budgeting.
+    """
+    count = 0
+    for token in TOKEN_PATTERN.findall(text or ''):
+        count += 1 + max(0, len(token) - 1) // 4
+    return count
+
+def is_ocr_junk_line(line):
+    """Return True for lines that are OCR noise rather than content"""
+    stripped = line.strip()
+    if not stripped:
+        return False
+    alnum = sum(ch.isalnum() for ch in stripped)
+    # Stray marks, ruler lines and speckle noise are mostly symbols
+    if alnum == 0:
+        return True
+    if len(stripped) <= 2 and not stripped.isalnum():
+        return True
+    return len(stripped) >= 4 and alnum / len(stripped) < 0.4
+
+def normalize_answer_text(text):
+    """Collapse whitespace and drop OCR junk lines, keeping paragraph breaks"""
+    lines = []
+    for raw_line in (text or '').splitlines():
+        line = ' '.join(raw_line.split())
+        if is_ocr_junk_line(line):
+            continue
+        if not line and (not lines or not lines[-1]):
+            continue
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return '\n'.join(lines)
+
+def find_boilerplate_lines(texts, min_share=None, reference_texts=()):
+    """Find lines repeated across a class's submissions (headers, templates).
+
+    A normalised line counts as boilerplate when it appears in at least
+    ``min_share`` of the submissions, and in at least two of them. Nothing
+    is stripped from classes smaller than BOILERPLATE_MIN_SUBMISSIONS, where
+    a shared correct answer is more likely than a shared template, and lines
+    that occur in ``reference_texts`` (the question or reference answer) are
+    always kept.
+    """
+    if min_share is None:
+        min_share = BOILERPLATE_MIN_SHARE
+    if len(texts) < max(2, BOILERPLATE_MIN_SUBMISSIONS):
+        return set()
+    counts = {}
+    for text in texts:
+        for line in set(normalize_answer_text(text).splitlines()):
+            if line:
+                key = line.lower()
+                counts[key] = counts.get(key, 0) + 1
+    threshold = max(2, int(len(texts) * min_share + 0.999))
+    # Line breaks in the reference do not matter, only its running text
+    reference = ' '.join(' '.join(normalize_answer_text(text).lower().split())
+                         for text in reference_texts if text)
+    return {line for line, seen in counts.items() if seen >= threshold and line not in reference}
+
+def strip_boilerplate(text, boilerplate):
+    """Remove boilerplate lines from already-normalised text"""
+    if not boilerplate:
+        return text
+    kept = [line for line in text.splitlines() if line.lower() not in boilerplate]
+    return '\n'.join(kept).strip('\n')
+
+def truncate_to_tokens(text, max_tokens):
+    """Deterministically shrink text to max_tokens by keeping its head and tail.
+
+    Whole lines are kept from the start and the end of the text (two thirds
+    of the budget for the head) and an omission marker replaces the middle.
+    """
+    if max_tokens <= 0:
+        return ''
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines()
+    marker_budget = 12
+    head_budget = max(0, (max_tokens - marker_budget) * 2 // 3)
+    tail_budget = max(0, max_tokens - marker_budget - head_budget)
+
+    head, used = [], 0
+    for line in lines:
+        cost = estimate_tokens(line)
+        if used + cost > head_budget:
+            break
+        head.append(line)
+        used += cost
+
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        cost = estimate_tokens(line)
+        if used + cost > tail_budget:
+            break
+        tail.insert(0, line)
+        used += cost
+
+    if not head and not tail:
+        # A single huge line: fall back to cutting on words
+        words = text.split()
+        kept = []
+        used = 0
+        for word in words:
+            cost = estimate_tokens(word)
+            if used + cost > max_tokens - marker_budget:
+                break
+            kept.append(word)
+            used += cost
+        return ' '.join(kept) + ' [... truncated ...]'
+
+    omitted = len(lines) - len(head) - len(tail)
+    return '\n'.join(head + [f'[... {omitted} lines omitted ...]'] + tail)
+
+def build_grading_prompt(question, correct_answer, student_answer, boilerplate=None, token_budget=None):
+    """Build the Gemini grading prompt, compacted to fit the token budget.
+
+    Returns the prompt and a dict of token counts before and after compaction.
+    """
+    if token_budget is None:
+        token_budget = PROMPT_TOKEN_BUDGET
+
+    raw_prompt = PROMPT_TEMPLATE.format(question=question,
+                                        correct_answer=correct_answer,
+                                        student_answer=student_answer)
+    tokens_before = estimate_tokens(raw_prompt)
+
+    question = normalize_answer_text(question)
+    correct_answer = normalize_answer_text(correct_answer)
+    student_answer = strip_boilerplate(normalize_answer_text(student_answer), boilerplate)
+
+    overhead = estimate_tokens(PROMPT_TEMPLATE.format(question='', correct_answer='', student_answer=''))
+    available = token_budget - overhead
+    truncated = False
+    parts = [question, correct_answer, student_answer]
+    if sum(estimate_tokens(part) for part in parts) > available:
+        truncated = True
+        # Give the student answer at least half of the budget, the reference
+        # material shares the rest, and any unused share flows back.
+        answer_share = max(available // 2, available - estimate_tokens(question) - estimate_tokens(correct_answer))
+        student_answer = truncate_to_tokens(student_answer, answer_share)
+        remaining = available - estimate_tokens(student_answer)
+        question_share = max(remaining // 2, remaining - estimate_tokens(correct_answer))
+        question = truncate_to_tokens(question, question_share)
+        correct_answer = truncate_to_tokens(correct_answer, remaining - estimate_tokens(question))
+
+    prompt = PROMPT_TEMPLATE.format(question=question,
+                                    correct_answer=correct_answer,
+                                    student_answer=student_answer)
+    # Per-part estimates do not quite add up once the parts are joined, so
+    # check the final prompt and trim the student answer again if needed
+    excess = estimate_tokens(prompt) - token_budget
+    while excess > 0 and student_answer:
+        truncated = True
+        answer_tokens = estimate_tokens(student_answer)
+        shorter = truncate_to_tokens(student_answer, answer_tokens - excess)
+        student_answer = shorter if estimate_tokens(shorter) < answer_tokens else ''
+        prompt = PROMPT_TEMPLATE.format(question=question,
+                                        correct_answer=correct_answer,
+                                        student_answer=student_answer)
+        excess = estimate_tokens(prompt) - token_budget
+    token_stats = {
+        'tokens_before': tokens_before,
+        'tokens_after': estimate_tokens(prompt),
+        'truncated': truncated
+    }
+    return prompt, token_stats
+
+class CircuitBreaker:
+    """Stop calling Gemini after repeated slow or failed calls.
+
+    After ``failure_threshold`` consecutive bad calls the breaker opens and
+    ``allow_request`` returns False for ``cooldown`` seconds. It then lets a
+    single probe call through (half-open); a good probe closes it again and
+    a bad one reopens it for another cooldown.
+    """
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                return 'half-open'
+            return 'open'
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown or self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    print(f"⚠️  Gemini circuit breaker open for {self.cooldown:.0f}s")
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+gemini_breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN_SECONDS)
+
+def analyze_answer_with_gemini(question, correct_answer, student_answer, boilerplate=None, timeout=None,
+                               on_chunk=None):
+    """Analyze student answer using Gemini AI
+
+    When ``on_chunk`` is given the response is streamed and each piece of
+    generated text is passed to it as it arrives.
+    """
+    if not model:
+        return {
+            'score': 0,
+            'feedback': 'AI model not available',
+            'details': 'Gemini AI is not properly configured'
+        }
+    
+    if timeout is None:
+        timeout = GEMINI_CALL_TIMEOUT
+    
+    try:
+        prompt, token_stats = build_grading_prompt(question, correct_answer, student_answer, boilerplate)
+        print(f"Prompt tokens: {token_stats['tokens_before']} -> {token_stats['tokens_after']}"
+              f"{' (truncated)' if token_stats['truncated'] else ''}")
         
-        response = model.generate_content(prompt)
+        started = time.monotonic()
+        try:
+            if on_chunk:
+                response_text = ''
+                for chunk in get_gemini_model().generate_content(prompt, stream=True,
+                                                                 request_options={'timeout': timeout}):
+                    response_text += chunk.text
+                    on_chunk(chunk.text)
+            else:
+                response_text = get_gemini_model().generate_content(prompt, request_options={'timeout': timeout}).text
+        except Exception:
+            gemini_breaker.record_failure()
+            raise
+        if time.monotonic() - started > GEMINI_SLOW_CALL_SECONDS:
+            gemini_breaker.record_failure()
+        else:
+            gemini_breaker.record_success()
         
         # Try to parse JSON from response
         try:
-            result = json.loads(response.text)
+            result = json.loads(response_text)
             return {
                 'score': result.get('score', 0),
                 'feedback': result.get('feedback', 'No feedback available'),
-                'suggestions': result.get('suggestions', 'No suggestions available')
+                'suggestions': result.get('suggestions', 'No suggestions available'),
+                'token_stats': token_stats
             }
         except json.JSONDecodeError:
             # If JSON parsing fails, extract information from text
-            text = response.text
+            text = response_text
             score_match = re.search(r'score.*?(\d+)', text, re.IGNORECASE)
             score = int(score_match.group(1)) if score_match else 5
             
             return {
                 'score': score,
                 'feedback': text,
-                'suggestions': 'Review the feedback above for improvement suggestions'
+                'suggestions': 'Review the feedback above for improvement suggestions',
+                'token_stats': token_stats
             }
     except Exception as e:
         return {
             'score': 0,
             'feedback': f'Error in AI evaluation: {str(e)}',
-            'suggestions': 'Please try again or contact support'
+            'suggestions': 'Please try again or contact support',
+            'failed': True
+        }
+
+RUBRIC_WORD_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# Only a plain decimal is a weight, so phrases like "Infinity" or "1e3" stay phrases
+RUBRIC_WEIGHT_PATTERN = re.compile(r'[+-]?\d+(?:\.\d+)?')
+
+def rubric_tokens(text):
+    """Lowercase word tokens with plural 's' stripped so 'networks' matches 'network'"""
+    tokens = []
+    for word in RUBRIC_WORD_PATTERN.findall((text or '').lower()):
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def parse_rubric(rubric_text):
+    """Parse a rubric file into weighted points.
+
+    Each non-empty line is ``weight | key phrase | synonym | ...``; the weight
+    is optional and defaults to 1. Lines starting with # are comments.
+    Raises ValueError for a weight that is not a positive number.
+    """
+    points = []
+    for line in rubric_text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [field.strip() for field in line.split('|') if field.strip()]
+        weight = 1.0
+        if RUBRIC_WEIGHT_PATTERN.fullmatch(fields[0]):
+            weight = float(fields[0])
+            if not (weight > 0 and math.isfinite(weight)):
+                raise ValueError(f"Rubric weight must be a positive number, got {fields[0]} in line '{line}'")
+            fields = fields[1:]
+        if fields:
+            points.append({'point': fields[0], 'weight': weight, 'phrases': fields})
+    return points
+
+def rubric_from_reference(reference):
+    """Derive rubric points from the key terms of a reference answer"""
+    counts, surface = {}, {}
+    for word in RUBRIC_WORD_PATTERN.findall((reference or '').lower()):
+        token = rubric_tokens(word)[0]
+        if len(token) > 3 and token not in STOP_WORDS and not token.isdigit():
+            counts[token] = counts.get(token, 0) + 1
+            surface.setdefault(token, word)
+    # Most frequent terms first; ties keep a stable alphabetical order
+    terms = sorted(counts, key=lambda term: (-counts[term], term))[:RUBRIC_MAX_REFERENCE_POINTS]
+    return [{'point': surface[term], 'weight': 1.0, 'phrases': [term]} for term in terms]
+
+class RubricMatcher:
+    """Aho-Corasick automaton over word tokens for a question's rubric.
+
+    Built once per question; ``match`` then finds every rubric phrase and
+    synonym in a student answer in a single linear pass over its words.
+    """
+
+    def __init__(self, points):
+        self.points = points
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for index, point in enumerate(points):
+            for phrase in point['phrases']:
+                state = 0
+                for word in rubric_tokens(phrase):
+                    next_state = self.goto[state].get(word)
+                    if next_state is None:
+                        next_state = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.output.append(())
+                        self.goto[state][word] = next_state
+                    state = next_state
+                if state:
+                    self.output[state] += (index,)
+
+        # Breadth-first pass to set failure links and merge outputs
+        pending = deque(self.goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for word, next_state in self.goto[state].items():
+                pending.append(next_state)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(word, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def match(self, text):
+        """Return the indexes of rubric points found in text"""
+        hits = set()
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for word in rubric_tokens(text):
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            if output[state]:
+                hits.update(output[state])
+        return hits
+
+    def score(self, text):
+        """Score text out of 10 by the weight of rubric points it covers"""
+        hits = self.match(text)
+        total = sum(point['weight'] for point in self.points)
+        earned = sum(self.points[index]['weight'] for index in hits)
+        return {
+            'score': round(min(10, earned / total * 10), 1) if total else 0,
+            'hit': [point['point'] for index, point in enumerate(self.points) if index in hits],
+            'missed': [point['point'] for index, point in enumerate(self.points) if index not in hits]
         }
 
-def simple_answer_comparison(question, correct_answer, student_answer):
+rubric_cache = {}
+rubric_cache_lock = threading.Lock()
+
+def get_rubric_matcher(correct_answer, rubric_text=None):
+    """Return the compiled rubric for a question, building it on first use"""
+    key = hashlib.sha1(f'{rubric_text or ""}\0{correct_answer}'.encode()).hexdigest()
+    with rubric_cache_lock:
+        matcher = rubric_cache.get(key)
+    if matcher is None:
+        points = parse_rubric(rubric_text) if rubric_text else rubric_from_reference(correct_answer)
+        matcher = RubricMatcher(points)
+        with rubric_cache_lock:
+            if len(rubric_cache) >= RUBRIC_CACHE_SIZE:
+                rubric_cache.pop(next(iter(rubric_cache)))
+            rubric_cache[key] = matcher
+    return matcher
+
+def simple_answer_comparison(question, correct_answer, student_answer, rubric_text=None):
     """Simple keyword-based answer comparison when AI is not available"""
-    if not nlp:
-        # Basic string matching fallback
-        correct_words = set(correct_answer.lower().split())
-        student_words = set(student_answer.lower().split())
-        overlap = len(correct_words.intersection(student_words))
-        score = min(10, (overlap / len(correct_words)) * 10) if correct_words else 0
+    if not nlp or rubric_text:
+        # Rubric matching: an explicit rubric file, or key terms of the answer
+        result = get_rubric_matcher(correct_answer, rubric_text).score(student_answer)
+        total = len(result['hit']) + len(result['missed'])
+        feedback = f"Rubric match: {len(result['hit'])} of {total} key points covered"
+        if result['hit']:
+            feedback += f" ({', '.join(result['hit'][:10])}{', ...' if len(result['hit']) > 10 else ''})"
+        suggestions = 'Include more key terms from the correct answer'
+        if result['missed']:
+            suggestions = f"Address the missing points: {', '.join(result['missed'][:10])}{', ...' if len(result['missed']) > 10 else ''}"
         
         return {
-            'score': round(score, 1),
-            'feedback': f'Basic comparison: {overlap} key terms matched out of {len(correct_words)}',
-            'suggestions': 'Include more key terms from the correct answer'
+            'score': result['score'],
+            'feedback': feedback,
+            'suggestions': suggestions,
+            'rubric_hits': result['hit'],
+            'rubric_missed': result['missed']
         }
     
-    # Use spaCy for better comparison
-    correct_doc = nlp(correct_answer)
-    student_doc = nlp(student_answer)
+    # Use spaCy for better comparison; the reference vector is cached so the
+    # reference answer is parsed once per question rather than once per answer
+    correct_vector = get_reference_vector(correct_answer)
+    student_vector = run_cpu_bound(nlp_vector, student_answer)
     
-    similarity = correct_doc.similarity(student_doc)
+    norms = float(np.linalg.norm(correct_vector) * np.linalg.norm(student_vector))
+    similarity = float(np.dot(correct_vector, student_vector)) / norms if norms else 0.0
     score = similarity * 10
     
     return {
@@ -242,115 +789,1652 @@ def simple_answer_comparison(question, correct_answer, student_answer):
         'suggestions': 'Try to include more relevant concepts and use similar terminology as the correct answer'
     }
 
+MERSENNE_PRIME = (1 << 61) - 1
+MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.blake2b(f'a{i}'.encode(), digest_size=8).digest(), 'big') % (MERSENNE_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f'b{i}'.encode(), digest_size=8).digest(), 'big') % MERSENNE_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+def shingle_text(text, size=SHINGLE_SIZE):
+    """Return the set of hashed word shingles for text"""
+    words = re.findall(r'\w+', (text or '').lower())
+    if words and len(words) < size:
+        size = len(words)
+    shingles = set()
+    for i in range(len(words) - size + 1 if words else 0):
+        shingle = ' '.join(words[i:i + size]).encode()
+        shingles.add(int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'big'))
+    return shingles
+
+def minhash_signature(text):
+    """Compute the MinHash signature of text's word shingles"""
+    shingles = shingle_text(text)
+    if not shingles:
+        return None
+    return [min((a * x + b) % MERSENNE_PRIME for x in shingles) for a, b in MINHASH_SEEDS]
+
+def signature_similarity(sig_a, sig_b):
+    """Estimate Jaccard similarity from two MinHash signatures"""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+def lsh_band_keys(signature):
+    """Split a signature into LSH band keys"""
+    rows = len(signature) // LSH_BANDS
+    return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(LSH_BANDS)]
+
+def find_near_duplicate_clusters(signatures, threshold=None):
+    """Group near-duplicate submissions using MinHash LSH.
+
+    Only submissions sharing an LSH band are compared, so the work grows
+    roughly linearly with class size. Submissions are taken in order and
+    each joins the most similar earlier representative it meets the
+    threshold against, or becomes a representative itself; members are
+    never joined through a chain of intermediate answers. Returns a list
+    of clusters, each a dict with the member indices (first is the
+    representative) and the lowest member similarity to the representative.
+    """
+    if threshold is None:
+        threshold = NEAR_DUPLICATE_THRESHOLD
+
+    buckets = {}
+    for i, signature in enumerate(signatures):
+        if signature is None:
+            continue
+        for key in lsh_band_keys(signature):
+            buckets.setdefault(key, []).append(i)
+
+    candidates = {}
+    for members in buckets.values():
+        for pos, i in enumerate(members):
+            for j in members[:pos]:
+                candidates.setdefault(i, set()).add(j)
+
+    clusters = {}
+    for i in range(len(signatures)):
+        best, best_similarity = None, threshold
+        for j in sorted(candidates.get(i, ())):
+            if j not in clusters:
+                continue
+            similarity = signature_similarity(signatures[i], signatures[j])
+            if similarity > best_similarity or (best is None and similarity >= threshold):
+                best, best_similarity = j, similarity
+        if best is None:
+            if signatures[i] is not None:
+                clusters[i] = {'members': [i], 'similarity': 1.0}
+        else:
+            clusters[best]['members'].append(i)
+            clusters[best]['similarity'] = min(clusters[best]['similarity'], best_similarity)
+
+    return [
+        {'members': cluster['members'], 'similarity': round(cluster['similarity'], 2)}
+        for _, cluster in sorted(clusters.items())
+        if len(cluster['members']) > 1
+    ]
+
+def load_minhash_index():
+    """Load signatures recorded by past sessions"""
+    entries = []
+    if not os.path.exists(MINHASH_INDEX_PATH):
+        return entries
+    try:
+        with open(MINHASH_INDEX_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    except Exception as e:
+        print(f"Error loading MinHash index: {e}")
+    return entries
+
+def append_minhash_index(session_id, filenames, signatures):
+    """Record this session's signatures for cross-session matching"""
+    try:
+        with file_lock(MINHASH_INDEX_LOCK_PATH), open(MINHASH_INDEX_PATH, 'a', encoding='utf-8') as f:
+            for filename, signature in zip(filenames, signatures):
+                if signature is not None:
+                    f.write(json.dumps({'session_id': session_id,
+                                        'student_file': filename,
+                                        'signature': signature}) + '\n')
+    except Exception as e:
+        print(f"Error updating MinHash index: {e}")
+
+def compact_minhash_index():
+    """Drop index entries for sessions that have been removed; returns the number dropped"""
+    if not os.path.exists(MINHASH_INDEX_PATH):
+        return 0
+    with file_lock(MINHASH_INDEX_LOCK_PATH):
+        lines, kept, live = 0, [], {}
+        with open(MINHASH_INDEX_PATH, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                session_id = entry['session_id']
+                if session_id not in live:
+                    live[session_id] = os.path.isdir(session_folder_path(session_id))
+                if live[session_id]:
+                    kept.append(line if line.endswith('\n') else line + '\n')
+        if len(kept) == lines:
+            return 0
+        tmp_path = MINHASH_INDEX_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(kept)
+        os.replace(tmp_path, MINHASH_INDEX_PATH)
+    return lines - len(kept)
+
+def find_past_duplicates(signatures, past_entries, threshold=None):
+    """Match this session's signatures against past sessions via LSH buckets"""
+    if threshold is None:
+        threshold = NEAR_DUPLICATE_THRESHOLD
+    buckets = {}
+    for pos, entry in enumerate(past_entries):
+        for key in lsh_band_keys(entry['signature']):
+            buckets.setdefault(key, []).append(pos)
+
+    matches = {}
+    for i, signature in enumerate(signatures):
+        if signature is None:
+            continue
+        candidates = set()
+        for key in lsh_band_keys(signature):
+            candidates.update(buckets.get(key, []))
+        for pos in sorted(candidates):
+            entry = past_entries[pos]
+            similarity = signature_similarity(signature, entry['signature'])
+            if similarity >= threshold:
+                matches.setdefault(i, []).append({
+                    'session_id': entry['session_id'],
+                    'student_file': entry['student_file'],
+                    'similarity': round(similarity, 2)
+                })
+    return matches
+
+def reuse_evaluation(evaluation, representative_file, representative_text, student_answer):
+    """Copy a representative's evaluation onto a near-duplicate submission"""
+    diff = [line for line in difflib.unified_diff(representative_text.splitlines(),
+                                                   student_answer.splitlines(), lineterm='', n=0)
+            if line[:1] in '+-' and not line.startswith(('+++', '---'))]
+    note = f'Grade reused from near-duplicate submission {representative_file}'
+    if diff:
+        note += f' ({len(diff)} differing lines: ' + ' | '.join(diff[:5]) + (' ...' if len(diff) > 5 else '') + ')'
+    else:
+        note += ' (identical text)'
+    reused = dict(evaluation)
+    reused['feedback'] = f"{note}. {evaluation['feedback']}"
+    return reused
+
+QUESTION_START_PATTERN = re.compile(r'^(?:q(?:uestion)?\s*)?\d+\s*[.):]', re.IGNORECASE)
+
+def content_hash(text):
+    """Hash text after normalisation so re-saved or re-spaced copies match"""
+    return hashlib.sha256(normalize_answer_text(text).lower().encode('utf-8')).hexdigest()
+
+def file_hash(path):
+    """Hash a file's raw bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def split_question_segments(text):
+    """Split a question paper into its numbered questions"""
+    segments, current = [], []
+    for line in normalize_answer_text(text).splitlines():
+        if QUESTION_START_PATTERN.match(line) and current:
+            segments.append('\n'.join(current))
+            current = []
+        if line:
+            current.append(line)
+    if current:
+        segments.append('\n'.join(current))
+    return segments
+
+class ReferenceBank:
+    """Persistent bank of question papers and their preprocessed references.
+
+    ``index.json`` holds each entry's hashes, canonical text and question
+    segments. MinHash signatures (``signatures.npy``) and spaCy vectors
+    (``vectors.npy``) are fixed-width arrays, one row per entry, loaded with
+    memory mapping so startup costs nothing and lookups touch only the
+    pages they need. Changes are made under a file lock after reloading
+    from disk, so several server processes can share one bank.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, 'index.json')
+        self.signatures_path = os.path.join(folder, 'signatures.npy')
+        self.vectors_path = os.path.join(folder, 'vectors.npy')
+        self.lock_path = os.path.join(folder, '.lock')
+        self.entries = None
+        self.signatures = None
+        self.vectors = None
+        self.loaded_stamp = None
+        self.lock = threading.Lock()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self):
+        """Load the bank, or reload it after another server process changed it"""
+        if self.entries is not None and self._stamp() == self.loaded_stamp:
+            return
+        with file_lock(self.lock_path):
+            self._read()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Hold the bank's locks with an up-to-date copy loaded, for a change"""
+        with self.lock, file_lock(self.lock_path):
+            if self.entries is None or self._stamp() != self.loaded_stamp:
+                self._read()
+            yield
+
+    def _read(self):
+        # Callers hold the file lock so the index and arrays are read together
+        self.loaded_stamp = self._stamp()
+        self.entries = []
+        self.signatures = np.zeros((0, MINHASH_PERMUTATIONS), dtype=np.uint64)
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+                self.signatures = np.load(self.signatures_path, mmap_mode='r')
+                self.vectors = np.load(self.vectors_path, mmap_mode='r')
+        except Exception as e:
+            print(f"Error loading question bank, starting empty: {e}")
+            self.entries = []
+            self.signatures = np.zeros((0, MINHASH_PERMUTATIONS), dtype=np.uint64)
+            self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    def _save(self, signatures=None, vectors=None):
+        # Only index.json is rewritten when the arrays are unchanged
+        if signatures is not None:
+            # Drop the memory maps before replacing the files they point at
+            self.signatures = self.vectors = None
+            for path, array in ((self.signatures_path, signatures), (self.vectors_path, vectors)):
+                tmp_path = path[:-len('.npy')] + '.tmp.npy'
+                np.save(tmp_path, array)
+                os.replace(tmp_path, path)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+        self.loaded_stamp = self._stamp()
+        if signatures is not None:
+            self.signatures = np.load(self.signatures_path, mmap_mode='r')
+            self.vectors = np.load(self.vectors_path, mmap_mode='r')
+
+    @staticmethod
+    def _stale_use(entry):
+        # Last use is saved at most once a day to keep lookups read-only
+        return time.time() - entry.get('last_used', 0) > 86400
+
+    def lookup_file(self, question_file_hash):
+        """Find a question paper by the hash of an identical upload"""
+        with self.lock:
+            self._load()
+            entry = next((entry for entry in self.entries if question_file_hash in entry['file_hashes']), None)
+        if entry and self._stale_use(entry):
+            with self._writing():
+                current = next((other for other in self.entries if other['text_hash'] == entry['text_hash']), None)
+                if current:
+                    current['last_used'] = time.time()
+                    self._save()
+        return entry
+
+    def lookup_text(self, text, question_file_hash=None):
+        """Find a known question paper with exactly the same content.
+
+        Matching entries remember ``question_file_hash`` so the next identical
+        upload is recognised before OCR. Papers that are only similar are not
+        matched, since a reworded question must be graded as uploaded.
+        """
+        text_hash = content_hash(text)
+        with self._writing():
+            entry = next((entry for entry in self.entries if entry['text_hash'] == text_hash), None)
+            if entry is None:
+                return None
+            changed = self._stale_use(entry)
+            if changed:
+                entry['last_used'] = time.time()
+            if question_file_hash and question_file_hash not in entry['file_hashes']:
+                entry['file_hashes'].append(question_file_hash)
+                changed = True
+            if changed:
+                self._save()
+            return entry
+
+    def nearest(self, text):
+        """Return the most similar stored paper and its MinHash similarity, or (None, 0)"""
+        signature = minhash_signature(normalize_answer_text(text))
+        with self.lock:
+            self._load()
+            if signature is None or not len(self.entries):
+                return None, 0.0
+            similarities = (self.signatures == np.array(signature, dtype=np.uint64)).mean(axis=1)
+            best = int(similarities.argmax())
+            return self.entries[best], float(similarities[best])
+
+    def add(self, text, question_file_hash=None):
+        """Preprocess a new question paper and store it in the bank"""
+        normalized = normalize_answer_text(text)
+        signature = minhash_signature(normalized) or [0] * MINHASH_PERMUTATIONS
+        vector = run_cpu_bound(nlp_vector, text).astype(np.float32) if nlp else None
+        model_id = spacy_model_id()
+        entry = {
+            'id': len(self.entries or []),
+            'text_hash': content_hash(text),
+            'file_hashes': [question_file_hash] if question_file_hash else [],
+            'text': text,
+            'segments': split_question_segments(text),
+            'vector_model': model_id if vector is not None else None,
+            'created': datetime.now().isoformat(),
+            'last_used': time.time()
+        }
+        with self._writing():
+            existing = next((other for other in self.entries if other['text_hash'] == entry['text_hash']), None)
+            if existing:
+                return existing
+            entry['id'] = len(self.entries)
+            vectors = np.array(self.vectors)
+            if vector is not None and vectors.shape[1] != vector.shape[0]:
+                # First vector, or the spaCy model changed: old rows are recomputed on use
+                vectors = np.zeros((len(self.entries), vector.shape[0]), dtype=np.float32)
+                for other in self.entries:
+                    other['vector_model'] = None
+            row = vector if vector is not None else np.zeros(vectors.shape[1], dtype=np.float32)
+            self.entries.append(entry)
+            self._save(np.vstack([self.signatures, np.array([signature], dtype=np.uint64)]),
+                       np.vstack([vectors, row[np.newaxis, :]]))
+        return entry
+
+    def reference_vector(self, text):
+        """Return the stored spaCy vector for a known reference text, if any"""
+        text_hash = content_hash(text)
+        with self.lock:
+            self._load()
+            for entry in self.entries:
+                if entry['text_hash'] == text_hash and entry['vector_model'] == spacy_model_id():
+                    return np.array(self.vectors[entry['id']])
+        return None
+
+    def usage(self):
+        """List (last used, text hash, approximate bytes) for each stored paper"""
+        with self.lock:
+            self._load()
+            row_bytes = (self.signatures.shape[1] * self.signatures.itemsize
+                         + self.vectors.shape[1] * self.vectors.itemsize)
+            return [(entry.get('last_used') or datetime.fromisoformat(entry['created']).timestamp(),
+                     entry['text_hash'], len(json.dumps(entry)) + row_bytes)
+                    for entry in self.entries]
+
+    def remove(self, text_hashes):
+        """Drop stored papers by text hash, renumbering the rest; returns the number removed"""
+        text_hashes = set(text_hashes)
+        if not text_hashes:
+            return 0
+        with self._writing():
+            keep = [i for i, entry in enumerate(self.entries) if entry['text_hash'] not in text_hashes]
+            removed = len(self.entries) - len(keep)
+            if removed:
+                self.entries = [self.entries[i] for i in keep]
+                for new_id, entry in enumerate(self.entries):
+                    entry['id'] = new_id
+                self._save(np.array(self.signatures)[keep], np.array(self.vectors)[keep])
+        return removed
+
+def spacy_model_id():
+    """Name and version of the loaded spaCy model, used to tag stored vectors"""
+    return f"{nlp.meta.get('name')}-{nlp.meta.get('version')}" if nlp else None
+
+reference_bank = ReferenceBank(QUESTION_BANK_FOLDER)
+reference_vectors = {}
+reference_vectors_lock = threading.Lock()
+
+def get_reference_vector(correct_answer):
+    """Return the spaCy vector for a reference answer, parsing it at most once"""
+    key = content_hash(correct_answer)
+    with reference_vectors_lock:
+        vector = reference_vectors.get(key)
+    if vector is None:
+        vector = reference_bank.reference_vector(correct_answer)
+        if vector is None:
+            vector = run_cpu_bound(nlp_vector, correct_answer)
+        with reference_vectors_lock:
+            if len(reference_vectors) >= RUBRIC_CACHE_SIZE:
+                reference_vectors.pop(next(iter(reference_vectors)))
+            reference_vectors[key] = vector
+    return vector
+
+def load_question(question_path, tenant, lane, reservation=None):
+    """Get a question paper's text, from the bank when it is a known paper.
+
+    An identical file skips OCR entirely. Otherwise the extracted text is
+    always used as uploaded; papers not yet in the bank (including revisions
+    of known ones) are preprocessed and stored as new entries.
+    """
+    question_file_hash = file_hash(question_path)
+    entry = reference_bank.lookup_file(question_file_hash)
+    if entry:
+        print(f"📚 Known question paper (bank entry {entry['id']}), skipping extraction")
+        return entry['text']
+    
+    question_text = scheduler.submit(tenant, lane, extract_text_from_file, question_path,
+                                     reservation=reservation).result()
+    if not question_text.strip():
+        return question_text
+    entry = reference_bank.lookup_text(question_text, question_file_hash)
+    if entry:
+        print(f"📚 Matched question paper to bank entry {entry['id']}")
+        return question_text
+    similar, similarity = reference_bank.nearest(question_text)
+    entry = reference_bank.add(question_text, question_file_hash)
+    print(f"📚 Added question paper to bank as entry {entry['id']} ({len(entry['segments'])} questions)")
+    if similar and similarity >= QUESTION_BANK_MATCH_THRESHOLD:
+        print(f"📚 Entry {entry['id']} looks like a revision of entry {similar['id']} ({similarity:.0%} similar)")
+    return question_text
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def grade_answer(question_text, student_answer, boilerplate, on_chunk=None, rubric_text=None):
+    """Grade one answer with Gemini, or the local NLP scorer as a fallback.
+
+    Each Gemini call is bounded by GEMINI_CALL_TIMEOUT, however long the
+    answer waited in the queue. When Gemini is configured but the breaker is
+    open or the call fails, the local score is marked provisional so it can
+    be regraded once Gemini recovers. ``rubric_text`` is an optional rubric
+    file used by the local scorer.
+    """
+    # For demo purposes, we'll treat the question text as both question and answer
+    # In a real scenario, you'd separate questions and answers
+    if not model:
+        return simple_answer_comparison(question_text, question_text, student_answer, rubric_text)
+    
+    if gemini_breaker.allow_request():
+        evaluation = analyze_answer_with_gemini(question_text, question_text, student_answer,
+                                                boilerplate, on_chunk=on_chunk)
+        if not evaluation.get('failed'):
+            return evaluation
+    
+    evaluation = simple_answer_comparison(question_text, question_text, student_answer, rubric_text)
+    evaluation['provisional'] = True
+    evaluation['feedback'] = f"Provisional score (AI grading unavailable, queued for regrading). {evaluation['feedback']}"
+    return evaluation
+
+def make_evaluation_record(answer_filename, student_answer, evaluation,
+                           cluster_id=None, duplicate_of=None, similar_past=None):
+    """Build the per-student entry shown on the results page and in the report"""
+    return {
+        'student_file': answer_filename,
+        'student_answer': student_answer[:500] + '...' if len(student_answer) > 500 else student_answer,
+        'score': evaluation['score'],
+        'feedback': evaluation['feedback'],
+        'suggestions': evaluation.get('suggestions', ''),
+        'token_stats': evaluation.get('token_stats'),
+        'duplicate_cluster': cluster_id,
+        'duplicate_of': duplicate_of,
+        'similar_past': similar_past or [],
+        'provisional': evaluation.get('provisional', False),
+        'rubric_hits': evaluation.get('rubric_hits'),
+        'rubric_missed': evaluation.get('rubric_missed')
+    }
+
+def session_folder_path(session_id):
+    """Return a session's upload folder, sharded by the first two characters of its id"""
+    sharded = os.path.join(UPLOAD_FOLDER, session_id[:2], session_id)
+    legacy = os.path.join(UPLOAD_FOLDER, session_id)
+    # Sessions saved before sharding live directly under UPLOAD_FOLDER
+    if not os.path.isdir(sharded) and os.path.isdir(legacy):
+        return legacy
+    return sharded
+
+def report_path(excel_filename):
+    """Return a report's path, sharded like its session's uploads"""
+    match = REPORT_NAME_PATTERN.match(excel_filename)
+    if not match:
+        return os.path.join(RESULTS_FOLDER, excel_filename)
+    sharded = os.path.join(RESULTS_FOLDER, match.group(1)[:2], excel_filename)
+    legacy = os.path.join(RESULTS_FOLDER, excel_filename)
+    if not os.path.exists(sharded) and os.path.exists(legacy):
+        return legacy
+    return sharded
+
+def blob_path(digest):
+    """Content-addressed location of an upload's bytes"""
+    return os.path.join(BLOB_FOLDER, digest[:2], digest[2:4], digest)
+
+def save_deduplicated(file_storage, dest_path):
+    """Save an uploaded file, storing identical bytes on disk only once.
+
+    The bytes are hashed while they are written, kept once under
+    BLOB_FOLDER, and hard-linked into the session folder (or copied where
+    hard links are unsupported). Returns the SHA-256 of the content.
+    """
+    digest = hashlib.sha256()
+    tmp_path = dest_path + '.part'
+    with open(tmp_path, 'wb') as out:
+        for block in iter(lambda: file_storage.stream.read(1 << 16), b''):
+            digest.update(block)
+            out.write(block)
+    digest = digest.hexdigest()
+    
+    blob = blob_path(digest)
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(blob, dest_path)
+        os.remove(tmp_path)
+        return digest
+    except FileNotFoundError:
+        pass
+    except OSError:
+        if os.path.exists(blob):
+            os.replace(tmp_path, dest_path)
+            return digest
+    os.replace(tmp_path, blob)
+    try:
+        os.link(blob, dest_path)
+    except OSError:
+        shutil.copyfile(blob, dest_path)
+    return digest
+
+def path_size(path):
+    """Bytes used by a file, or by every file under a directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+    return total
+
+def folder_usage(folder):
+    """Split a session folder's bytes into files only it holds and links to stored blobs.
+
+    Returns the bytes of its own files and a dict of the blobs it links to,
+    keyed by inode, with their sizes.
+    """
+    own, blobs = 0, {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink > 1:
+                blobs[(stat.st_dev, stat.st_ino)] = stat.st_size
+            else:
+                own += stat.st_size
+    return own, blobs
+
+def session_units():
+    """Group each session's upload folder and reports, which are kept and evicted together"""
+    units = {}
+    
+    def unit(session_id):
+        return units.setdefault(session_id, {'folder': None, 'reports': [], 'uploaded': None,
+                                             'modified': 0.0, 'own': 0, 'blobs': {}})
+    
+    for shard in os.listdir(UPLOAD_FOLDER):
+        shard_path = os.path.join(UPLOAD_FOLDER, shard)
+        if shard_path == BLOB_FOLDER or not os.path.isdir(shard_path):
+            continue
+        # Two-character shards hold sessions; longer names are legacy sessions
+        folders = [shard_path] if len(shard) > 2 else [os.path.join(shard_path, name) for name in os.listdir(shard_path)]
+        for folder in folders:
+            state = os.path.join(folder, SESSION_STATE_FILE)
+            try:
+                modified = os.path.getmtime(state if os.path.exists(state) else folder)
+            except FileNotFoundError:
+                continue
+            own, blobs = folder_usage(folder)
+            item = unit(os.path.basename(folder))
+            item.update(folder=folder, uploaded=modified, own=item['own'] + own)
+            item['modified'] = max(item['modified'], modified)
+            item['blobs'].update(blobs)
+    
+    for root, _, names in os.walk(RESULTS_FOLDER):
+        for name in names:
+            match = REPORT_NAME_PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            item = unit(match.group(1))
+            item['reports'].append(path)
+            item['modified'] = max(item['modified'], stat.st_mtime)
+            item['own'] += stat.st_size
+    return units
+
+def remove_item(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def remove_unit(item):
+    """Delete a session's upload folder, saved state and reports"""
+    for path in item['reports'] + ([item['folder']] if item['folder'] else []):
+        remove_item(path)
+
+def strip_uploads(folder):
+    """Delete a session's uploaded files, keeping its saved state and rubric.
+
+    Files saved or linked within BLOB_GRACE_SECONDS (a late submission still
+    being graded) are left alone. Returns the number of files deleted.
+    """
+    removed = 0
+    now = time.time()
+    for name in os.listdir(folder):
+        if not (name.startswith(UPLOAD_FILE_PREFIXES) or name.endswith('.part')):
+            continue
+        path = os.path.join(folder, name)
+        try:
+            if now - os.stat(path).st_ctime < BLOB_GRACE_SECONDS:
+                continue
+        except FileNotFoundError:
+            continue
+        remove_item(path)
+        removed += 1
+    return removed
+
+def collect_blobs():
+    """Delete stored blobs that no session links to any more"""
+    freed = 0
+    now = time.time()
+    for root, _, names in os.walk(BLOB_FOLDER):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # Linking updates ctime, so a blob just saved or reused is left alone
+            if stat.st_nlink == 1 and now - stat.st_ctime > BLOB_GRACE_SECONDS:
+                remove_item(path)
+                freed += stat.st_size
+    return freed
+
+def run_storage_cleanup():
+    """Expire old uploads, sessions and question papers, then evict the oldest while over quota.
+
+    Uploaded files go after UPLOAD_TTL_HOURS, but a session's saved state is
+    kept as long as its report so the results page and late submissions
+    keep working. Usage counts each stored blob once, however many sessions
+    link to it, plus the MinHash index and the question bank.
+    """
+    now = time.time()
+    evicted = stripped = 0
+    kept = []
+    for item in session_units().values():
+        if now - item['modified'] > REPORT_TTL_HOURS * 3600:
+            remove_unit(item)
+            evicted += 1
+            continue
+        if item['folder'] and now - item['uploaded'] > UPLOAD_TTL_HOURS * 3600 and strip_uploads(item['folder']):
+            folder_own, item['blobs'] = folder_usage(item['folder'])
+            item['own'] = folder_own + sum(path_size(path) for path in item['reports'])
+            stripped += 1
+        kept.append(item)
+    
+    removed_papers = reference_bank.remove(text_hash for last_used, text_hash, _ in reference_bank.usage()
+                                           if now - last_used > QUESTION_BANK_TTL_HOURS * 3600)
+    
+    # Blobs are freed once the last session linking to them is evicted
+    links = {}
+    for item in kept:
+        for inode in item['blobs']:
+            links[inode] = links.get(inode, 0) + 1
+    
+    usage = (sum(item['own'] for item in kept) + path_size(BLOB_FOLDER) + path_size(QUESTION_BANK_FOLDER)
+             + (path_size(MINHASH_INDEX_PATH) if os.path.exists(MINHASH_INDEX_PATH) else 0))
+    quota = STORAGE_QUOTA_MB * 1024 * 1024
+    candidates = sorted([(item['modified'], 'session', item) for item in kept] +
+                        [(last_used, 'paper', (text_hash, size)) for last_used, text_hash, size in reference_bank.usage()],
+                        key=lambda candidate: (candidate[0], candidate[1]))
+    evicted_papers = set()
+    for modified, kind, candidate in candidates:
+        if usage <= quota:
+            break
+        # Never evict work from the last hour; it may still be in progress
+        if now - modified < 3600:
+            continue
+        if kind == 'paper':
+            evicted_papers.add(candidate[0])
+            usage -= candidate[1]
+            continue
+        remove_unit(candidate)
+        usage -= candidate['own']
+        for inode, size in candidate['blobs'].items():
+            links[inode] -= 1
+            if not links[inode]:
+                usage -= size
+        evicted += 1
+    
+    removed_papers += reference_bank.remove(evicted_papers)
+    dropped_signatures = compact_minhash_index()
+    freed = collect_blobs()
+    if evicted or stripped or removed_papers or dropped_signatures or freed:
+        print(f"🧹 Storage janitor evicted {evicted} session(s), removed uploads of {stripped}, "
+              f"{removed_papers} question paper(s) and {dropped_signatures} index entries, "
+              f"freed {freed / 1024 / 1024:.1f} MB of blobs")
+
+storage_janitor = None
+storage_janitor_lock = threading.Lock()
+
+def run_storage_janitor():
+    while True:
+        try:
+            run_storage_cleanup()
+        except Exception as e:
+            print(f"Error in storage janitor: {e}")
+        time.sleep(STORAGE_JANITOR_INTERVAL)
+
+@app.before_request
+def start_storage_janitor():
+    """Start the background janitor with the first request in each process"""
+    global storage_janitor
+    if storage_janitor is not None and storage_janitor.is_alive():
+        return
+    with storage_janitor_lock:
+        if storage_janitor is None or not storage_janitor.is_alive():
+            storage_janitor = threading.Thread(target=run_storage_janitor, daemon=True)
+            storage_janitor.start()
+
+def session_state_path(session_id):
+    """Return the state file path for a session, or None for a malformed id"""
+    try:
+        session_id = str(uuid.UUID(session_id))
+    except ValueError:
+        return None
+    return os.path.join(session_folder_path(session_id), SESSION_STATE_FILE)
+
+def session_lock(session_id):
+    """Return the lock that serialises updates to one session's state and report.
+
+    It is a file lock in the session folder, so it holds across server
+    processes as well as threads.
+    """
+    return file_lock(os.path.join(os.path.dirname(session_state_path(session_id)), SESSION_LOCK_FILE))
+
+def save_session_state(session_id, state):
+    """Persist what later appends need: question text, boilerplate and evaluations"""
+    path = session_state_path(session_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def load_session_state(session_id):
+    """Load a session's saved state, or None if the session is unknown"""
+    path = session_state_path(session_id)
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class SchedulerFull(Exception):
+    """Raised when admission control turns away new work"""
+
+class SchedulerReservation:
+    """Queue capacity admitted up front for every stage of one upload.
+
+    Use as a context manager; unused capacity is returned on exit.
+    """
+
+    def __init__(self, scheduler, tenant, slots):
+        self.scheduler = scheduler
+        self.tenant = tenant
+        self.slots = slots
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.scheduler.release(self)
+
+class FairScheduler:
+    """Share a fixed pool of worker threads fairly between tenants.
+
+    Tasks are queued per lane and per tenant. Lanes are served by stride
+    scheduling in proportion to LANE_WEIGHTS, so interactive uploads move
+    ahead of bulk batches without starving them, and within a lane each
+    tenant gets a share proportional to its TENANT_WEIGHTS entry (default 1).
+    Work is rejected with SchedulerFull once the global or per-tenant queue
+    limit would be exceeded. A multi-stage upload takes a reservation first
+    so it cannot be admitted for extraction and then turned away at grading.
+    """
+
+    def __init__(self, workers, queue_limit, tenant_queue_limit):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.tenant_queue_limit = tenant_queue_limit
+        self.queues = {lane: {} for lane in LANE_WEIGHTS}
+        self.tenant_pass = {lane: {} for lane in LANE_WEIGHTS}
+        self.lane_pass = {lane: 0.0 for lane in LANE_WEIGHTS}
+        self.queued = 0
+        # Admission counts reserved slots plus queued tasks outside any reservation
+        self.reserved = 0
+        self.tenant_reserved = {}
+        self.unreserved = 0
+        self.tenant_unreserved = {}
+        self.waits = {}
+        self.threads = []
+        self.cond = threading.Condition()
+
+    def _admit(self, tenant, count):
+        if self.unreserved + self.reserved + count > self.queue_limit:
+            raise SchedulerFull('Grading queue is full, please try again in a few minutes')
+        tenant_load = self.tenant_unreserved.get(tenant, 0) + self.tenant_reserved.get(tenant, 0)
+        if tenant_load + count > self.tenant_queue_limit:
+            raise SchedulerFull(f'Too much work already queued for {tenant}, please wait for it to finish')
+
+    def reserve(self, tenant, slots):
+        """Admit ``slots`` tasks now for work that will be submitted in stages"""
+        with self.cond:
+            self._admit(tenant, slots)
+            self.reserved += slots
+            self.tenant_reserved[tenant] = self.tenant_reserved.get(tenant, 0) + slots
+        return SchedulerReservation(self, tenant, slots)
+
+    def release(self, reservation):
+        """Return a reservation's capacity"""
+        with self.cond:
+            self.reserved -= reservation.slots
+            self.tenant_reserved[reservation.tenant] -= reservation.slots
+            if not self.tenant_reserved[reservation.tenant]:
+                del self.tenant_reserved[reservation.tenant]
+            reservation.slots = 0
+
+    def submit_many(self, tenant, lane, fn, args_list, reservation=None):
+        """Queue fn(*args) for each args tuple, admitting all or none of them.
+
+        Tasks submitted under a reservation use its capacity; a stage larger
+        than the reservation is admitted for the difference.
+        """
+        futures = []
+        with self.cond:
+            if reservation is None:
+                self._admit(tenant, len(args_list))
+                self.unreserved += len(args_list)
+                self.tenant_unreserved[tenant] = self.tenant_unreserved.get(tenant, 0) + len(args_list)
+            elif len(args_list) > reservation.slots:
+                extra = len(args_list) - reservation.slots
+                self._admit(tenant, extra)
+                reservation.slots += extra
+                self.reserved += extra
+                self.tenant_reserved[tenant] += extra
+            self._start_workers()
+            
+            lane_queues = self.queues[lane]
+            if not any(lane_queues.values()):
+                # An idle lane rejoins at the current minimum pass instead of
+                # cashing in credit built up while it had nothing to do
+                self.lane_pass[lane] = max(self.lane_pass[lane], self._min_pass(self.lane_pass, self.queues))
+            if not lane_queues.get(tenant):
+                active = {name: value for name, value in self.tenant_pass[lane].items() if lane_queues.get(name)}
+                start = min(active.values()) if active else 0.0
+                self.tenant_pass[lane][tenant] = max(self.tenant_pass[lane].get(tenant, 0.0), start)
+                lane_queues.setdefault(tenant, deque())
+            
+            now = time.monotonic()
+            for args in args_list:
+                future = Future()
+                lane_queues[tenant].append((now, future, fn, args, reservation is not None))
+                futures.append(future)
+            self.queued += len(args_list)
+            self.cond.notify(len(args_list))
+        return futures
+
+    def submit(self, tenant, lane, fn, *args, reservation=None):
+        return self.submit_many(tenant, lane, fn, [args], reservation)[0]
+
+    def _min_pass(self, passes, queues):
+        active = [passes[lane] for lane in passes if any(queues[lane].values())]
+        return min(active) if active else 0.0
+
+    def _start_workers(self):
+        # Started on first use so gunicorn's pre-fork master never owns them
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._run_worker, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _next_task(self):
+        lanes = [lane for lane in LANE_WEIGHTS if any(self.queues[lane].values())]
+        lane = min(lanes, key=lambda name: (self.lane_pass[name], name))
+        self.lane_pass[lane] += 1.0 / LANE_WEIGHTS[lane]
+        
+        lane_queues = self.queues[lane]
+        tenants = [name for name, tasks in lane_queues.items() if tasks]
+        tenant = min(tenants, key=lambda name: (self.tenant_pass[lane][name], name))
+        self.tenant_pass[lane][tenant] += 1.0 / TENANT_WEIGHTS.get(tenant, 1.0)
+        
+        task = lane_queues[tenant].popleft()
+        if not lane_queues[tenant]:
+            del lane_queues[tenant]
+        self.queued -= 1
+        if not task[-1]:
+            self.unreserved -= 1
+            self.tenant_unreserved[tenant] -= 1
+            if not self.tenant_unreserved[tenant]:
+                del self.tenant_unreserved[tenant]
+        return tenant, task
+
+    def _run_worker(self):
+        while True:
+            with self.cond:
+                while not self.queued:
+                    self.cond.wait()
+                tenant, (enqueued_at, future, fn, args, _) = self._next_task()
+                self.waits.setdefault(tenant, deque(maxlen=500)).append(time.monotonic() - enqueued_at)
+            
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        """Queue depth and wait-time percentiles per tenant"""
+        with self.cond:
+            tenants = set(self.waits)
+            for lane in LANE_WEIGHTS:
+                tenants.update(self.queues[lane])
+            report = {}
+            for tenant in sorted(tenants):
+                waits = sorted(self.waits.get(tenant, ()))
+                report[tenant] = {
+                    'queued': {lane: len(self.queues[lane].get(tenant, ())) for lane in LANE_WEIGHTS},
+                    'tasks_started': len(waits),
+                    'wait_p50_seconds': round(percentile(waits, 50), 3),
+                    'wait_p95_seconds': round(percentile(waits, 95), 3)
+                }
+            return {'workers': self.workers, 'queued': self.queued, 'reserved': self.reserved, 'tenants': report}
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+scheduler = FairScheduler(SCHEDULER_WORKERS, SCHEDULER_QUEUE_LIMIT, SCHEDULER_TENANT_QUEUE_LIMIT)
+
+def get_tenant():
+    """Identify the teacher or course the request is for"""
+    tenant = request.form.get('tenant') or request.headers.get('X-Tenant-ID') or request.remote_addr or 'anonymous'
+    return re.sub(r'[^\w.@-]+', '-', tenant.strip().lower())[:64] or 'anonymous'
+
+def get_lane(file_count):
+    """Small uploads go in the interactive lane, large batches in the bulk lane"""
+    return 'interactive' if file_count <= INTERACTIVE_MAX_FILES else 'bulk'
+
+regrade_queue = queue.Queue()
+regrade_worker = None
+regrade_worker_lock = threading.Lock()
+
+def queue_provisional_regrades(session_id, results, start_index=0):
+    """Queue provisional evaluations for background regrading with Gemini"""
+    global regrade_worker
+    indexes = [i for i in range(start_index, len(results['evaluations']))
+               if results['evaluations'][i].get('provisional')]
+    if not indexes:
+        return
+    for index in indexes:
+        regrade_queue.put((session_id, index, 0))
+    # Started lazily so gunicorn's pre-fork master never owns the thread
+    with regrade_worker_lock:
+        if regrade_worker is None or not regrade_worker.is_alive():
+            regrade_worker = threading.Thread(target=run_regrade_worker, daemon=True)
+            regrade_worker.start()
+
+def run_regrade_worker():
+    """Regrade provisional evaluations once the Gemini circuit breaker allows it"""
+    while True:
+        session_id, index, attempts = regrade_queue.get()
+        try:
+            regrade_evaluation(session_id, index, attempts)
+        except Exception as e:
+            print(f"Error regrading {session_id} #{index}: {e}")
+        finally:
+            regrade_queue.task_done()
+
+def claim_regrade(session_id, index):
+    """Mark a provisional evaluation as being regraded by this process.
+
+    Returns False if it is no longer provisional or another process holds a
+    claim younger than REGRADE_CLAIM_SECONDS.
+    """
+    with session_lock(session_id):
+        state = load_session_state(session_id)
+        if state is None:
+            return False
+        evaluation = state['results']['evaluations'][index]
+        if not evaluation.get('provisional'):
+            return False
+        if time.time() - evaluation.get('regrading', 0) < REGRADE_CLAIM_SECONDS:
+            return False
+        evaluation['regrading'] = time.time()
+        save_session_state(session_id, state)
+    return True
+
+def release_regrade(session_id, index):
+    """Drop this process's claim after a failed regrade so it can be retried"""
+    with session_lock(session_id):
+        state = load_session_state(session_id)
+        if state is None:
+            return
+        evaluation = state['results']['evaluations'][index]
+        if evaluation.pop('regrading', None) is not None:
+            save_session_state(session_id, state)
+
+def regrade_evaluation(session_id, index, attempts):
+    """Replace one provisional evaluation with a Gemini grade and update the report"""
+    if not model:
+        return
+    state = load_session_state(session_id)
+    if state is None or not state['results']['evaluations'][index].get('provisional'):
+        return
+    
+    while not gemini_breaker.allow_request():
+        time.sleep(min(CIRCUIT_COOLDOWN_SECONDS, 5))
+    
+    # Every server process recovers the same provisional evaluations, so
+    # claim this one before calling Gemini and leave it to whoever got there first
+    if not claim_regrade(session_id, index):
+        return
+    
+    submission = state['submissions'][index]
+    boilerplate = set(state['boilerplate'])
+    evaluation = analyze_answer_with_gemini(state['question_text'], state['question_text'],
+                                            submission['text'], boilerplate)
+    if evaluation.get('failed'):
+        release_regrade(session_id, index)
+        if attempts + 1 < REGRADE_MAX_ATTEMPTS:
+            regrade_queue.put((session_id, index, attempts + 1))
+        return
+    
+    with session_lock(session_id):
+        state = load_session_state(session_id)
+        if state is None or not state['results']['evaluations'][index].get('provisional'):
+            return
+        results = state['results']
+        submissions = state['submissions']
+        updated = [index]
+        previous = results['evaluations'][index]
+        results['evaluations'][index] = make_evaluation_record(
+            previous['student_file'], submission['text'], evaluation,
+            cluster_id=previous['duplicate_cluster'], duplicate_of=previous['duplicate_of'],
+            similar_past=previous['similar_past'])
+        
+        # Copies of this grade made for near-duplicates follow the regrade
+        if state['reuse_duplicates']:
+            for i, other in enumerate(submissions):
+                if i != index and other['representative'] == index and results['evaluations'][i].get('provisional'):
+                    copy = reuse_evaluation(evaluation, submission['student_file'], submission['text'], other['text'])
+                    prior = results['evaluations'][i]
+                    results['evaluations'][i] = make_evaluation_record(
+                        prior['student_file'], other['text'], copy,
+                        cluster_id=prior['duplicate_cluster'], duplicate_of=prior['duplicate_of'],
+                        similar_past=prior['similar_past'])
+                    updated.append(i)
+        
+        update_excel_report_rows(state['excel_filename'], results, updated)
+        save_session_state(session_id, state)
+    print(f"✅ Regraded {len(updated)} provisional evaluation(s) in session {session_id}")
+
+def recover_provisional_regrades():
+    """Requeue provisional evaluations saved before a restart or worker recycle"""
+    if not model:
+        return
+    recovered = 0
+    for root, dirs, names in os.walk(UPLOAD_FOLDER):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) != BLOB_FOLDER]
+        if SESSION_STATE_FILE not in names:
+            continue
+        session_id = os.path.basename(root)
+        try:
+            state = load_session_state(session_id)
+        except Exception as e:
+            print(f"Error reading session state for {session_id}: {e}")
+            continue
+        if state:
+            before = regrade_queue.qsize()
+            queue_provisional_regrades(session_id, state['results'])
+            recovered += regrade_queue.qsize() - before
+    if recovered:
+        print(f"🔁 Requeued {recovered} provisional evaluation(s) for regrading")
+
+regrade_recovery_started = False
+
+@app.before_request
+def start_regrade_recovery():
+    """Scan saved sessions for provisional grades with the first request in each process"""
+    global regrade_recovery_started
+    with regrade_worker_lock:
+        if regrade_recovery_started:
+            return
+        regrade_recovery_started = True
+    threading.Thread(target=recover_provisional_regrades, daemon=True).start()
+
+class UploadError(Exception):
+    """Raised for uploads that cannot be processed, with a message for the user"""
+
+def save_upload():
+    """Validate the uploaded files and save them into a new session folder.
+
+    Returns the session id, the question file path, a list of
+    (answer filename, saved path) pairs and the optional rubric text.
+    """
+    # Check if files were uploaded
+    if 'question_file' not in request.files or 'answer_files' not in request.files:
+        raise UploadError('Missing required files')
+    
+    question_file = request.files['question_file']
+    answer_files = request.files.getlist('answer_files')
+    
+    if question_file.filename == '':
+        raise UploadError('No question file selected')
+    
+    if not answer_files or all(f.filename == '' for f in answer_files):
+        raise UploadError('No answer files selected')
+    
+    if not allowed_file(question_file.filename):
+        raise UploadError('Invalid question file format')
+    
+    rubric_file = request.files.get('rubric_file')
+    rubric_text = None
+    if rubric_file and rubric_file.filename:
+        if not rubric_file.filename.lower().endswith('.txt'):
+            raise UploadError('Rubric must be a .txt file')
+        rubric_text = rubric_file.read().decode('utf-8', errors='replace')
+        try:
+            points = parse_rubric(rubric_text)
+        except ValueError as e:
+            raise UploadError(str(e))
+        if not points:
+            raise UploadError('Rubric file has no key points')
+    
+    # Create unique session folder
+    session_id = str(uuid.uuid4())
+    session_folder = session_folder_path(session_id)
+    os.makedirs(session_folder, exist_ok=True)
+    
+    question_filename = secure_filename(question_file.filename)
+    question_path = os.path.join(session_folder, 'question_' + question_filename)
+    save_deduplicated(question_file, question_path)
+    
+    saved_answers = []
+    for i, answer_file in enumerate(answer_files):
+        if answer_file and allowed_file(answer_file.filename):
+            answer_filename = secure_filename(answer_file.filename)
+            answer_path = os.path.join(session_folder, f'answer_{i}_{answer_filename}')
+            save_deduplicated(answer_file, answer_path)
+            saved_answers.append((answer_filename, answer_path))
+    
+    if rubric_text:
+        with open(os.path.join(session_folder, 'rubric.txt'), 'w', encoding='utf-8') as f:
+            f.write(rubric_text)
+    
+    return session_id, question_path, saved_answers, rubric_text
+
+def process_session(session_id, question_path, saved_answers, reuse_grades, tenant, lane,
+                    emit=None, rubric_text=None):
+    """Extract, deduplicate and grade a saved upload, then write its report.
+
+    ``emit(event, data)`` is called as each file is extracted and graded so
+    callers can stream progress. Returns the results and report filename.
+    """
+    # Gemini output is only streamed when the caller streams progress
+    streaming = emit is not None
+    if emit is None:
+        emit = lambda event, data: None
+    results = {'session_id': session_id, 'evaluations': [], 'duplicate_clusters': []}
+    
+    # Capacity for every stage is admitted before any work starts, so an
+    # upload is never turned away at grading after its OCR has run
+    with scheduler.reserve(tenant, max(1, len(saved_answers))) as reservation:
+        question_text = load_question(question_path, tenant, lane, reservation)
+        if not question_text.strip():
+            raise UploadError('Could not extract text from question file')
+        
+        # Extract all answer files first so boilerplate shared across the
+        # class can be stripped from every prompt. OCR runs on the shared
+        # scheduler so one large upload cannot monopolise it.
+        extractions = scheduler.submit_many(tenant, lane, extract_text_from_file,
+                                            [(path,) for _, path in saved_answers], reservation)
+        for i, future in enumerate(extractions):
+            future.add_done_callback(lambda _, i=i: emit('extracted', {
+                'index': i, 'student_file': saved_answers[i][0]}))
+        submissions = [(name, future.result()) for (name, _), future in zip(saved_answers, extractions)]
+        
+        boilerplate = find_boilerplate_lines([text for _, text in submissions], reference_texts=[question_text])
+        
+        # Find near-duplicate clusters; boilerplate is stripped first so a
+        # shared template alone does not make two answers look copied
+        signatures = [minhash_signature(strip_boilerplate(normalize_answer_text(text), boilerplate))
+                      for _, text in submissions]
+        clusters = find_near_duplicate_clusters(signatures)
+        representative_of = {}
+        for cluster_id, cluster in enumerate(clusters, start=1):
+            for member in cluster['members']:
+                representative_of[member] = (cluster_id, cluster['members'][0])
+            results['duplicate_clusters'].append({
+                'cluster_id': cluster_id,
+                'files': [submissions[member][0] for member in cluster['members']],
+                'similarity': cluster['similarity']
+            })
+        
+        past_matches = {}
+        if CROSS_SESSION_DUPLICATES:
+            past_matches = find_past_duplicates(signatures, load_minhash_index())
+            append_minhash_index(session_id, [name for name, _ in submissions], signatures)
+        
+        def emit_result(i, evaluation):
+            emit('result', {
+                'index': i,
+                'student_file': submissions[i][0],
+                'score': evaluation['score'],
+                'feedback': evaluation['feedback'],
+                'suggestions': evaluation.get('suggestions', ''),
+                'provisional': evaluation.get('provisional', False)
+            })
+        
+        # Grade every answer that is not a reused near-duplicate
+        to_grade = [i for i in range(len(submissions))
+                    if not (reuse_grades and representative_of.get(i, (None, i))[1] != i)]
+        gradings = scheduler.submit_many(tenant, lane, grade_answer, [
+            (question_text, submissions[i][1], boilerplate,
+             (lambda text, i=i: emit('partial', {'index': i, 'text': text})) if streaming else None, rubric_text)
+            for i in to_grade
+        ], reservation)
+        for i, future in zip(to_grade, gradings):
+            future.add_done_callback(lambda done, i=i: done.exception() or emit_result(i, done.result()))
+        graded = {i: future.result() for i, future in zip(to_grade, gradings)}
+    
+    # Process answer files
+    for i, (answer_filename, student_answer) in enumerate(submissions):
+        cluster_id, representative = representative_of.get(i, (None, i))
+        if i in graded:
+            evaluation = graded[i]
+        else:
+            evaluation = reuse_evaluation(graded[representative], submissions[representative][0],
+                                          submissions[representative][1], student_answer)
+            emit_result(i, evaluation)
+        
+        results['evaluations'].append(make_evaluation_record(
+            answer_filename, student_answer, evaluation,
+            cluster_id=cluster_id,
+            duplicate_of=submissions[representative][0] if representative != i else None,
+            similar_past=past_matches.get(i)))
+    
+    # Generate Excel report
+    excel_path = generate_excel_report(results, session_id)
+    
+    save_session_state(session_id, {
+        'question_text': question_text,
+        'rubric_text': rubric_text,
+        'boilerplate': sorted(boilerplate),
+        'reuse_duplicates': reuse_grades,
+        'excel_filename': excel_path,
+        'results': results,
+        'submissions': [
+            {'student_file': name, 'text': text, 'signature': signature,
+             'representative': representative_of.get(i, (None, i))[1]}
+            for i, ((name, text), signature) in enumerate(zip(submissions, signatures))
+        ]
+    })
+    queue_provisional_regrades(session_id, results)
+    
+    return results, excel_path
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     try:
-        # Check if files were uploaded
-        if 'question_file' not in request.files or 'answer_files' not in request.files:
-            flash('Missing required files')
-            return redirect(url_for('index'))
+        session_id, question_path, saved_answers, rubric_text = save_upload()
+        lane = get_lane(len(saved_answers))
         
-        question_file = request.files['question_file']
-        answer_files = request.files.getlist('answer_files')
+        results, excel_path = process_session(session_id, question_path, saved_answers,
+                                              request.form.get('reuse_duplicates') == 'on',
+                                              get_tenant(), lane, rubric_text=rubric_text)
         
-        if question_file.filename == '':
-            flash('No question file selected')
-            return redirect(url_for('index'))
+        return render_template('results.html', 
+                             results=results, 
+                             excel_path=excel_path,
+                             session_id=session_id)
         
+    except (UploadError, SchedulerFull) as e:
+        flash(str(e))
+        return redirect(url_for('index'))
+    except Exception as e:
+        flash(f'Error processing files: {str(e)}')
+        return redirect(url_for('index'))
+
+def format_sse(event, data):
+    """Encode one Server-Sent Events message"""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+@app.route('/upload/stream', methods=['POST'])
+def upload_files_stream():
+    """Grade an upload, streaming per-file progress and feedback as Server-Sent Events"""
+    try:
+        session_id, question_path, saved_answers, rubric_text = save_upload()
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    reuse_grades = request.form.get('reuse_duplicates') == 'on'
+    tenant = get_tenant()
+    lane = get_lane(len(saved_answers))
+    results_url = url_for('session_results', session_id=session_id)
+    events = queue.Queue()
+    
+    def run():
+        try:
+            _, excel_path = process_session(session_id, question_path, saved_answers, reuse_grades,
+                                            tenant, lane, emit=lambda event, data: events.put((event, data)),
+                                            rubric_text=rubric_text)
+            events.put(('done', {'results_url': results_url, 'excel_filename': excel_path}))
+        except (UploadError, SchedulerFull) as e:
+            events.put(('error', {'message': str(e)}))
+        except Exception as e:
+            events.put(('error', {'message': f'Error processing files: {str(e)}'}))
+        finally:
+            events.put(None)
+    
+    # Grading runs outside the request so results can be sent as they finish
+    threading.Thread(target=run, daemon=True).start()
+    
+    def generate():
+        yield format_sse('start', {
+            'session_id': session_id,
+            'files': [name for name, _ in saved_answers]
+        })
+        while True:
+            item = events.get()
+            if item is None:
+                break
+            yield format_sse(*item)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/session/<session_id>')
+def session_results(session_id):
+    """Show the stored results of an earlier session"""
+    state = load_session_state(session_id)
+    if state is None:
+        flash('Session not found')
+        return redirect(url_for('index'))
+    return render_template('results.html',
+                         results=state['results'],
+                         excel_path=state['excel_filename'],
+                         session_id=state['results']['session_id'])
+
+@app.route('/session/<session_id>/append', methods=['POST'])
+def append_answers(session_id):
+    """Grade late submissions into an existing session without regrading the class.
+
+    The new files are extracted and graded in parallel without holding any
+    lock; the session's own lock is taken only to merge them into its state
+    and report, so other sessions and background regrades are not held up.
+    """
+    try:
+        answer_files = request.files.getlist('answer_files')
         if not answer_files or all(f.filename == '' for f in answer_files):
             flash('No answer files selected')
             return redirect(url_for('index'))
+        tenant = get_tenant()
+        lane = get_lane(len(answer_files))
+        
+        state = load_session_state(session_id)
+        if state is None:
+            flash('Session not found')
+            return redirect(url_for('index'))
         
-        # Create unique session folder
-        session_id = str(uuid.uuid4())
-        session_folder = os.path.join(UPLOAD_FOLDER, session_id)
-        os.makedirs(session_folder, exist_ok=True)
+        session_folder = os.path.dirname(session_state_path(session_id))
+        boilerplate = set(state['boilerplate'])
         
-        results = {'session_id': session_id, 'evaluations': []}
+        saved_answers = []
+        for answer_file in answer_files:
+            if not (answer_file and allowed_file(answer_file.filename)):
+                continue
+            answer_filename = secure_filename(answer_file.filename)
+            # Appends to one session can run at the same time, so late files
+            # get a random prefix rather than their final position
+            answer_path = os.path.join(session_folder, f'answer_{uuid.uuid4().hex[:8]}_{answer_filename}')
+            save_deduplicated(answer_file, answer_path)
+            saved_answers.append((answer_filename, answer_path))
+        if not saved_answers:
+            flash('Invalid answer file format')
+            return redirect(url_for('index'))
         
-        # Process question file
-        if question_file and allowed_file(question_file.filename):
-            question_filename = secure_filename(question_file.filename)
-            question_path = os.path.join(session_folder, 'question_' + question_filename)
-            question_file.save(question_path)
+        with scheduler.reserve(tenant, len(saved_answers)) as reservation:
+            extractions = scheduler.submit_many(tenant, lane, extract_text_from_file,
+                                                [(path,) for _, path in saved_answers], reservation)
+            texts = [future.result() for future in extractions]
+            signatures = [minhash_signature(strip_boilerplate(normalize_answer_text(text), boilerplate))
+                          for text in texts]
             
-            question_text = extract_text_from_file(question_path)
-            if not question_text.strip():
-                flash('Could not extract text from question file')
-                return redirect(url_for('index'))
-        else:
-            flash('Invalid question file format')
-            return redirect(url_for('index'))
+            # Compare each late answer against the session's representatives and
+            # the new representatives before it, so it cannot join a cluster
+            # through one of its members. Positions from ``offset`` on refer to
+            # this batch until it is merged.
+            offset = len(state['submissions'])
+            representatives = [(j, previous['signature']) for j, previous in enumerate(state['submissions'])
+                               if previous['representative'] == j and previous['signature'] is not None]
+            matches = []
+            for k, signature in enumerate(signatures):
+                match, best = None, NEAR_DUPLICATE_THRESHOLD
+                if signature is not None:
+                    for j, other in representatives:
+                        similarity = signature_similarity(signature, other)
+                        if similarity > best or (match is None and similarity >= best):
+                            match, best = j, similarity
+                matches.append((match, best))
+                if match is None and signature is not None:
+                    representatives.append((offset + k, signature))
+            
+            # The session's own earlier files are already covered by its clusters
+            past_matches = {}
+            if CROSS_SESSION_DUPLICATES:
+                past_entries = [entry for entry in load_minhash_index() if entry['session_id'] != session_id]
+                past_matches = find_past_duplicates(signatures, past_entries)
+                append_minhash_index(session_id, [name for name, _ in saved_answers], signatures)
+            
+            to_grade = [k for k, (match, _) in enumerate(matches)
+                        if not (state['reuse_duplicates'] and match is not None)]
+            gradings = scheduler.submit_many(tenant, lane, grade_answer, [
+                (state['question_text'], texts[k], boilerplate, None, state.get('rubric_text'))
+                for k in to_grade
+            ], reservation)
+            graded = {k: future.result() for k, future in zip(to_grade, gradings)}
         
-        # Process answer files
-        for i, answer_file in enumerate(answer_files):
-            if answer_file and allowed_file(answer_file.filename):
-                answer_filename = secure_filename(answer_file.filename)
-                answer_path = os.path.join(session_folder, f'answer_{i}_{answer_filename}')
-                answer_file.save(answer_path)
-                
-                student_answer = extract_text_from_file(answer_path)
+        with session_lock(session_id):
+            state = load_session_state(session_id)
+            results = state['results']
+            submissions = state['submissions']
+            start_index = len(results['evaluations'])
+            
+            for k, ((answer_filename, _), student_answer) in enumerate(zip(saved_answers, texts)):
+                i = start_index + k
+                match, best = matches[k]
+                cluster_id, representative = None, i
+                if match is not None:
+                    # Another append may have been merged since this one started
+                    representative = match if match < offset else start_index + match - offset
+                    cluster_id = results['evaluations'][representative]['duplicate_cluster']
+                    if cluster_id is None:
+                        cluster_id = len(results['duplicate_clusters']) + 1
+                        results['duplicate_clusters'].append({
+                            'cluster_id': cluster_id,
+                            'files': [submissions[representative]['student_file']],
+                            'similarity': 1.0
+                        })
+                        results['evaluations'][representative]['duplicate_cluster'] = cluster_id
+                    cluster = results['duplicate_clusters'][cluster_id - 1]
+                    cluster['files'].append(answer_filename)
+                    cluster['similarity'] = round(min(cluster['similarity'], best), 2)
                 
-                # For demo purposes, we'll treat the question text as both question and answer
-                # In a real scenario, you'd separate questions and answers
-                if model:
-                    evaluation = analyze_answer_with_gemini(question_text, question_text, student_answer)
+                if k in graded:
+                    evaluation = graded[k]
                 else:
-                    evaluation = simple_answer_comparison(question_text, question_text, student_answer)
+                    evaluation = reuse_evaluation(results['evaluations'][representative],
+                                                  submissions[representative]['student_file'],
+                                                  submissions[representative]['text'], student_answer)
                 
-                results['evaluations'].append({
-                    'student_file': answer_filename,
-                    'student_answer': student_answer[:500] + '...' if len(student_answer) > 500 else student_answer,
-                    'score': evaluation['score'],
-                    'feedback': evaluation['feedback'],
-                    'suggestions': evaluation.get('suggestions', '')
-                })
-        
-        # Generate Excel report
-        excel_path = generate_excel_report(results, session_id)
+                results['evaluations'].append(make_evaluation_record(
+                    answer_filename, student_answer, evaluation,
+                    cluster_id=cluster_id,
+                    duplicate_of=submissions[representative]['student_file'] if representative != i else None,
+                    similar_past=past_matches.get(k)))
+                submissions.append({'student_file': answer_filename, 'text': student_answer,
+                                    'signature': signatures[k], 'representative': representative})
+            
+            append_excel_report(state['excel_filename'], results, start_index)
+            save_session_state(session_id, state)
+        queue_provisional_regrades(session_id, results, start_index)
         
-        return render_template('results.html', 
-                             results=results, 
-                             excel_path=excel_path,
+        return render_template('results.html',
+                             results=results,
+                             excel_path=state['excel_filename'],
                              session_id=session_id)
-        
+    
+    except SchedulerFull as e:
+        flash(str(e))
+        return redirect(url_for('index'))
     except Exception as e:
         flash(f'Error processing files: {str(e)}')
         return redirect(url_for('index'))
 
+def report_row(index, eval_result):
+    """Build one Excel report row for an evaluation"""
+    return {
+        'Student': f'Student {index+1}',
+        'File Name': eval_result['student_file'],
+        'Score': eval_result['score'],
+        'Feedback': eval_result['feedback'],
+        'Suggestions': eval_result['suggestions'],
+        'Prompt Tokens (raw)': (eval_result.get('token_stats') or {}).get('tokens_before'),
+        'Prompt Tokens (sent)': (eval_result.get('token_stats') or {}).get('tokens_after'),
+        'Duplicate Cluster': eval_result.get('duplicate_cluster'),
+        'Similar Past Submissions': ', '.join(
+            f"{match['student_file']} ({match['similarity']:.2f})"
+            for match in eval_result.get('similar_past', [])),
+        'Provisional': 'Yes' if eval_result.get('provisional') else '',
+        'Rubric Points Hit': ', '.join(eval_result.get('rubric_hits') or []),
+        'Rubric Points Missed': ', '.join(eval_result.get('rubric_missed') or [])
+    }
+
+def cluster_rows(results):
+    """Build the Near Duplicates sheet rows"""
+    return [{
+        'Cluster': cluster['cluster_id'],
+        'Files': ', '.join(cluster['files']),
+        'Similarity to Representative': cluster['similarity']
+    } for cluster in results.get('duplicate_clusters', [])]
+
 def generate_excel_report(results, session_id):
     """Generate Excel report with evaluation results"""
     df_data = []
     
     for i, eval_result in enumerate(results['evaluations']):
-        df_data.append({
-            'Student': f'Student {i+1}',
-            'File Name': eval_result['student_file'],
-            'Score': eval_result['score'],
-            'Feedback': eval_result['feedback'],
-            'Suggestions': eval_result['suggestions']
-        })
+        df_data.append(report_row(i, eval_result))
     
     df = pd.DataFrame(df_data)
     
     excel_filename = f'evaluation_report_{session_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    excel_path = os.path.join(RESULTS_FOLDER, excel_filename)
+    excel_path = report_path(excel_filename)
+    os.makedirs(os.path.dirname(excel_path), exist_ok=True)
     
-    df.to_excel(excel_path, index=False, engine='openpyxl')
+    with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Evaluations', index=False)
+        if results.get('duplicate_clusters'):
+            pd.DataFrame(cluster_rows(results)).to_excel(writer, sheet_name='Near Duplicates', index=False)
     
     return excel_filename
 
+def save_workbook(workbook, excel_path):
+    """Save a report through a temporary file so readers never see a partial one"""
+    tmp_path = excel_path + '.tmp'
+    workbook.save(tmp_path)
+    os.replace(tmp_path, excel_path)
+
+def update_excel_report_rows(excel_filename, results, indexes):
+    """Rewrite the given evaluation rows of an existing report in place"""
+    excel_path = report_path(excel_filename)
+    workbook = load_workbook(excel_path)
+    sheet = workbook['Evaluations']
+    headers = [cell.value for cell in sheet[1]]
+    
+    for i in indexes:
+        row = report_row(i, results['evaluations'][i])
+        for column, header in enumerate(headers, start=1):
+            sheet.cell(row=i + 2, column=column, value=row.get(header))
+    
+    save_workbook(workbook, excel_path)
+
+def append_excel_report(excel_filename, results, start_index):
+    """Append evaluations from start_index onward to an existing report in place"""
+    excel_path = report_path(excel_filename)
+    workbook = load_workbook(excel_path)
+    sheet = workbook['Evaluations']
+    headers = [cell.value for cell in sheet[1]]
+    
+    for i in range(start_index, len(results['evaluations'])):
+        row = report_row(i, results['evaluations'][i])
+        sheet.append([row.get(header) for header in headers])
+    
+    # Cluster membership can change for earlier rows, so refresh that column
+    # and rewrite the (small) Near Duplicates sheet
+    if 'Duplicate Cluster' in headers:
+        column = headers.index('Duplicate Cluster') + 1
+        for i in range(start_index):
+            sheet.cell(row=i + 2, column=column, value=results['evaluations'][i].get('duplicate_cluster'))
+    if results.get('duplicate_clusters'):
+        if 'Near Duplicates' in workbook.sheetnames:
+            del workbook['Near Duplicates']
+        clusters_sheet = workbook.create_sheet('Near Duplicates')
+        rows = cluster_rows(results)
+        clusters_sheet.append(list(rows[0].keys()))
+        for row in rows:
+            clusters_sheet.append(list(row.values()))
+    
+    save_workbook(workbook, excel_path)
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """Download generated Excel report"""
     try:
-        file_path = os.path.join(RESULTS_FOLDER, filename)
+        file_path = report_path(secure_filename(filename))
         if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+            # Reports change in place when late or regraded answers arrive, so
+            # clients revalidate with If-None-Match / If-Modified-Since and get
+            # 304 Not Modified while the file is unchanged
+            return send_file(file_path, as_attachment=True, conditional=True, etag=True, max_age=0)
         else:
             flash('File not found')
             return redirect(url_for('index'))
@@ -358,6 +2442,11 @@ def download_file(filename):
         flash(f'Error downloading file: {str(e)}')
         return redirect(url_for('index'))
 
+@app.route('/scheduler/stats')
+def scheduler_stats():
+    """Per-tenant queue depth and queue wait times"""
+    return jsonify(scheduler.stats())
+
 @app.route('/health')
 def health_check():
     """Health check endpoint"""
@@ -365,6 +2454,10 @@ def health_check():
         'status': 'healthy',
         'gemini_configured': model is not None,
         'spacy_loaded': nlp is not None,
+        'gemini_circuit': gemini_breaker.state,
+        'pending_regrades': regrade_queue.qsize(),
+        'scheduler_queued': scheduler.stats()['queued'],
+        'cpu_workers': CPU_WORKERS,
         'timestamp': datetime.now().isoformat()
     })
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Batch Grading CLI for AI Assignment Checker
+Grades a directory or manifest of answer files without the web server,
+streaming one JSON line per evaluation
+"""
+
+import os
+import sys
+import json
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# app.py reports progress with print(); keep stdout clean for the JSON lines
+json_stdout = sys.stdout
+with contextlib.redirect_stdout(sys.stderr):
+    import app
+
+ANSWER_EXTENSIONS = tuple('.' + ext for ext in app.ALLOWED_EXTENSIONS)
+
+def quiet_worker():
+    """Send a worker process's app output to stderr"""
+    sys.stdout = sys.stderr
+
+def extract_answer(path):
+    """Extract one answer file's text (runs in a worker)"""
+    return path, app.extract_text_from_file(path)
+
+def grade_answer(path, question_text, student_answer, boilerplate, rubric_text):
+    """Grade one extracted answer (runs in a worker)"""
+    return path, app.grade_answer(question_text, student_answer, boilerplate, rubric_text=rubric_text)
+
+def list_answer_files(answers, manifest):
+    """Collect answer file paths from a directory or a manifest file"""
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        paths = []
+        with open(manifest, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                # Either a bare path per line or JSON lines with a "path" key
+                path = json.loads(line)['path'] if line.startswith('{') else line
+                paths.append(path if os.path.isabs(path) else os.path.join(base, path))
+        return paths
+
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(answers)
+        for name in names
+        if name.lower().endswith(ANSWER_EXTENSIONS)
+    )
+
+def load_checkpoint(checkpoint):
+    """Load extracted texts, finished evaluations and failures from a checkpoint file.
+
+    Files that failed are returned separately so a resumed run skips them
+    without counting them as graded; provisional grades are never
+    checkpointed, so those answers are graded again.
+    """
+    extracted, finished, errors = {}, {}, {}
+    if not checkpoint or not os.path.exists(checkpoint):
+        return extracted, finished, errors
+    with open(checkpoint, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by an interrupted run
+                continue
+            if record.get('type') == 'extracted':
+                extracted[record['path']] = record['text']
+            elif record.get('type') == 'evaluation':
+                finished[record['path']] = record['evaluation']
+            elif record.get('type') == 'error':
+                errors[record['path']] = record
+    return extracted, finished, errors
+
+def make_executor(workers, processes):
+    if processes:
+        return ProcessPoolExecutor(max_workers=workers, initializer=quiet_worker)
+    return ThreadPoolExecutor(max_workers=workers)
+
+def run_batch(args):
+    """Extract and grade every answer, writing JSON lines as results finish"""
+    with contextlib.redirect_stdout(sys.stderr):
+        question_text = app.extract_text_from_file(args.question)
+    if not question_text.strip():
+        print(f"❌ Could not extract text from question file: {args.question}", file=sys.stderr)
+        return 1
+
+    rubric_text = None
+    if args.rubric:
+        with open(args.rubric, 'r', encoding='utf-8') as f:
+            rubric_text = f.read()
+        try:
+            if not app.parse_rubric(rubric_text):
+                print(f"❌ Rubric file has no key points: {args.rubric}", file=sys.stderr)
+                return 1
+        except ValueError as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+
+    paths = list_answer_files(args.answers, args.manifest)
+    if not paths:
+        print("❌ No answer files found", file=sys.stderr)
+        return 1
+
+    extracted, finished, errors = load_checkpoint(args.checkpoint)
+    resumed_errors = [path for path in paths if path in errors]
+    if finished or resumed_errors:
+        print(f"↩️  Resuming: {len(finished)} of {len(paths)} answers already graded, "
+              f"{len(resumed_errors)} failed in an earlier run", file=sys.stderr)
+
+    output = open(args.output, 'a' if args.checkpoint else 'w', encoding='utf-8') if args.output else json_stdout
+    checkpoint = open(args.checkpoint, 'a', encoding='utf-8') if args.checkpoint else None
+
+    def record_checkpoint(record):
+        if checkpoint:
+            checkpoint.write(json.dumps(record) + '\n')
+            checkpoint.flush()
+
+    failed = []
+
+    def record_error(path, stage, error):
+        record = {'path': path, 'student_file': os.path.basename(path), 'error': f'{stage} failed: {error}'}
+        output.write(json.dumps(record) + '\n')
+        output.flush()
+        record_checkpoint(dict(record, type='error'))
+        failed.append(path)
+        print(f"❌ {path}: {record['error']}", file=sys.stderr)
+
+    try:
+        with make_executor(args.workers, args.processes) as executor, \
+                contextlib.redirect_stdout(sys.stderr):
+            # Extract everything first so boilerplate shared across the whole
+            # batch is stripped from every prompt, as in the web app
+            pending = {executor.submit(extract_answer, path): path
+                       for path in paths if path not in extracted and path not in finished and path not in errors}
+            for future in as_completed(pending):
+                try:
+                    path, text = future.result()
+                except Exception as e:
+                    # One unreadable file must not stop the batch
+                    record_error(pending[future], 'extraction', e)
+                    continue
+                extracted[path] = text
+                record_checkpoint({'type': 'extracted', 'path': path, 'text': text})
+
+            boilerplate = app.find_boilerplate_lines([extracted[path] for path in paths if path in extracted],
+                                                     reference_texts=[question_text])
+
+            futures = {executor.submit(grade_answer, path, question_text, extracted[path], boilerplate, rubric_text): path
+                       for path in paths if path in extracted and path not in finished and path not in errors}
+            graded = 0
+            for future in as_completed(futures):
+                try:
+                    path, evaluation = future.result()
+                except Exception as e:
+                    record_error(futures[future], 'grading', e)
+                    continue
+                record = app.make_evaluation_record(os.path.basename(path), extracted[path], evaluation)
+                record['path'] = path
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                # Provisional grades are written but not checkpointed, so a
+                # resumed run grades them again once Gemini is back
+                if not record['provisional']:
+                    record_checkpoint({'type': 'evaluation', 'path': path, 'evaluation': record})
+                graded += 1
+                print(f"✅ [{len(finished) + graded}/{len(paths)}] {path}: {record['score']}/10"
+                      f"{' (provisional)' if record['provisional'] else ''}", file=sys.stderr)
+    finally:
+        if output is not json_stdout:
+            output.close()
+        if checkpoint:
+            checkpoint.close()
+
+    if failed or resumed_errors:
+        earlier = f" ({len(resumed_errors)} in an earlier run)" if resumed_errors else ''
+        print(f"⚠️  {len(failed) + len(resumed_errors)} of {len(paths)} answer files could not be graded{earlier}",
+              file=sys.stderr)
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Grade answer files against a question file and stream JSON lines')
+    parser.add_argument('question', help='question paper file (PDF, image or text)')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--answers', help='directory of answer files (searched recursively)')
+    source.add_argument('--manifest', help='file listing answer paths, one per line or JSON lines with a "path" key')
+    parser.add_argument('--output', '-o', help='write JSON lines here instead of stdout')
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count() or 4,
+                        help='parallel extraction and grading workers (default: CPU count)')
+    parser.add_argument('--processes', action='store_true',
+                        help='use worker processes instead of threads (better for CPU-bound OCR and spaCy)')
+    parser.add_argument('--rubric', help='rubric file of weighted key phrases for local scoring')
+    parser.add_argument('--checkpoint', help='checkpoint file; rerun with the same file to resume')
+    args = parser.parse_args()
+
+    return run_batch(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+"""
+Gunicorn configuration for AI Assignment Checker
+
+Grading spends most of its time waiting on Gemini and Tesseract, so the
+default serving mode is threaded (gthread): each process loads spaCy once
+and serves GUNICORN_THREADS requests concurrently. The app's OCR and
+grading scheduler gets the same number of threads unless SCHEDULER_WORKERS
+is set. CPU-heavy PDF parsing and spaCy work can be moved to a small
+process pool with CPU_WORKERS.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+# Grading a class and streaming its results can take minutes
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+graceful_timeout = 30
+keepalive = 5
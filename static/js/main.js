@@ -11,7 +11,6 @@ function initializeUploadForm() {
     const form = document.getElementById('uploadForm');
     const submitBtn = document.getElementById('submitBtn');
     const progressDiv = document.getElementById('uploadProgress');
-    const progressBar = progressDiv ? progressDiv.querySelector('.progress-bar') : null;
 
     if (form) {
         form.addEventListener('submit', function(e) {
@@ -29,12 +28,196 @@ function initializeUploadForm() {
 
             if (progressDiv) {
                 progressDiv.style.display = 'block';
-                simulateProgress();
             }
+
+            // Stream results when the browser can read the response as it arrives;
+            // otherwise fall back to a normal form post
+            if (form.dataset.streamUrl && window.fetch && window.ReadableStream && window.TextDecoder) {
+                e.preventDefault();
+                streamUpload(form);
+            } else {
+                setProgress(100, 'Processing files... This may take a few minutes.');
+            }
+        });
+    }
+}
+
+function setProgress(percent, message) {
+    const progressBar = document.querySelector('#uploadProgress .progress-bar');
+    const progressText = document.getElementById('progressText');
+    if (progressBar) {
+        progressBar.style.width = percent + '%';
+        progressBar.setAttribute('aria-valuenow', percent);
+    }
+    if (progressText && message) {
+        progressText.textContent = message;
+    }
+}
+
+function resetSubmitButton() {
+    const submitBtn = document.getElementById('submitBtn');
+    if (submitBtn) {
+        submitBtn.disabled = false;
+        submitBtn.innerHTML = '<i class="fas fa-magic me-2"></i>Start AI Evaluation';
+    }
+}
+
+async function streamUpload(form) {
+    const state = { files: [], extracted: 0, graded: 0, finished: false };
+    const liveResults = document.getElementById('liveResults');
+    if (liveResults) {
+        liveResults.innerHTML = '';
+    }
+
+    try {
+        const response = await fetch(form.dataset.streamUrl, {
+            method: 'POST',
+            body: new FormData(form)
         });
+
+        if (!response.ok) {
+            const error = await response.json().catch(() => ({}));
+            throw new Error(error.error || `Upload failed (${response.status})`);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // Server-Sent Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const message = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+                handleStreamEvent(parseStreamEvent(message), state);
+            }
+        }
+
+        // A proxy or timeout can cut the stream off without a final event
+        if (!state.finished) {
+            throw new Error('The connection was closed before grading finished. Please try again.');
+        }
+    } catch (error) {
+        showNotification(error.message, 'danger');
+        setProgress(0, 'Processing failed.');
+        resetSubmitButton();
     }
 }
 
+function parseStreamEvent(message) {
+    let event = 'message';
+    let data = '';
+    message.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            data += line.slice(5).trim();
+        }
+    });
+    return { event: event, data: data ? JSON.parse(data) : {} };
+}
+
+function handleStreamEvent({ event, data }, state) {
+    // Extraction and grading each count for half of a file's progress
+    const total = Math.max(1, state.files.length * 2);
+
+    switch (event) {
+        case 'start':
+            state.files = data.files;
+            data.files.forEach((name, index) => addLiveResult(index, name));
+            setProgress(0, `Processing ${data.files.length} answer sheets...`);
+            break;
+        case 'extracted':
+            state.extracted += 1;
+            updateLiveStatus(data.index, 'Grading...');
+            setProgress(Math.round((state.extracted + state.graded) / total * 100),
+                        `Extracted ${state.extracted} of ${state.files.length} answer sheets`);
+            break;
+        case 'partial':
+            appendLiveFeedback(data.index, data.text);
+            break;
+        case 'result':
+            state.graded += 1;
+            showLiveResult(data);
+            setProgress(Math.round((state.extracted + state.graded) / total * 100),
+                        `Graded ${state.graded} of ${state.files.length} answer sheets`);
+            break;
+        case 'done':
+            state.finished = true;
+            setProgress(100, 'All answer sheets graded.');
+            showResultsLink(data.results_url);
+            resetSubmitButton();
+            break;
+        case 'error':
+            state.finished = true;
+            showNotification(data.message, 'danger');
+            setProgress(0, 'Processing failed.');
+            resetSubmitButton();
+            break;
+    }
+}
+
+function addLiveResult(index, name) {
+    const liveResults = document.getElementById('liveResults');
+    if (!liveResults) return;
+
+    const item = document.createElement('div');
+    item.id = `liveResult${index}`;
+    item.className = 'list-group-item';
+    item.innerHTML = `
+        <div class="d-flex justify-content-between align-items-center">
+            <strong></strong>
+            <span class="badge bg-secondary">Extracting...</span>
+        </div>
+        <small class="text-muted d-block mt-1 live-feedback"></small>
+    `;
+    item.querySelector('strong').textContent = name;
+    liveResults.appendChild(item);
+}
+
+function updateLiveStatus(index, status) {
+    const badge = document.querySelector(`#liveResult${index} .badge`);
+    if (badge) {
+        badge.textContent = status;
+    }
+}
+
+function appendLiveFeedback(index, text) {
+    const feedback = document.querySelector(`#liveResult${index} .live-feedback`);
+    if (feedback) {
+        feedback.textContent += text;
+    }
+}
+
+function showLiveResult(result) {
+    const badge = document.querySelector(`#liveResult${result.index} .badge`);
+    const feedback = document.querySelector(`#liveResult${result.index} .live-feedback`);
+    if (badge) {
+        const score = Number(result.score);
+        badge.className = `badge ${score >= 8 ? 'bg-success' : score >= 6 ? 'bg-warning' : 'bg-danger'}`;
+        badge.textContent = `${result.score}/10${result.provisional ? ' (provisional)' : ''}`;
+    }
+    if (feedback) {
+        feedback.textContent = result.feedback;
+    }
+}
+
+function showResultsLink(resultsUrl) {
+    const liveResults = document.getElementById('liveResults');
+    if (!liveResults) return;
+
+    const link = document.createElement('a');
+    link.href = resultsUrl;
+    link.className = 'btn btn-success mt-3';
+    link.innerHTML = '<i class="fas fa-chart-bar me-2"></i>View Full Results and Excel Report';
+    liveResults.after(link);
+}
+
 function validateFiles() {
     const questionFile = document.getElementById('question_file');
     const answerFiles = document.getElementById('answer_files');
@@ -86,25 +269,6 @@ function isValidFileType(file) {
     return validTypes.includes(file.type) || file.name.toLowerCase().match(/\.(pdf|png|jpg|jpeg|gif|txt)$/);
 }
 
-function simulateProgress() {
-    const progressBar = document.querySelector('#uploadProgress .progress-bar');
-    if (!progressBar) return;
-
-    let progress = 0;
-    const interval = setInterval(() => {
-        progress += Math.random() * 15;
-        if (progress > 90) progress = 90;
-        
-        progressBar.style.width = progress + '%';
-        progressBar.setAttribute('aria-valuenow', progress);
-        
-        if (progress >= 90) {
-            clearInterval(interval);
-            progressBar.style.width = '100%';
-        }
-    }, 500);
-}
-
 function initializeFilePreview() {
     const questionFile = document.getElementById('question_file');
     const answerFiles = document.getElementById('answer_files');
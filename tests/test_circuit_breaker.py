@@ -0,0 +1,68 @@
+import pytest
+
+app = pytest.importorskip('app')
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return clock
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow_request()
+        breaker.record_failure()
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = app.CircuitBreaker(3, 60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow_request()
+    clock.now += 59
+    assert not breaker.allow_request()
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = app.CircuitBreaker(2, 60)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.state == 'half-open'
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    assert not breaker.allow_request()
+
+def test_good_probe_closes(clock):
+    breaker = app.CircuitBreaker(2, 60)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+
+def test_bad_probe_reopens_for_a_full_cooldown(clock):
+    breaker = app.CircuitBreaker(2, 60)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    clock.now += 59
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
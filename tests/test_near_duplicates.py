@@ -0,0 +1,35 @@
+import pytest
+
+app = pytest.importorskip('app')
+
+def edited_chain(steps=5, length=120):
+    """Answers where each one rewrites a fresh part of the one before it"""
+    words = [f'word{i}' for i in range(length)]
+    texts = []
+    for step in range(steps):
+        texts.append(' '.join(words))
+        for k in range(step * 24 + 2, step * 24 + 26, 8):
+            words[k] = f'edit{step}x{k}'
+    return texts
+
+def test_clusters_do_not_chain_through_members():
+    signatures = [app.minhash_signature(text) for text in edited_chain()]
+    for i in range(len(signatures) - 1):
+        assert app.signature_similarity(signatures[i], signatures[i + 1]) >= 0.8
+    assert app.signature_similarity(signatures[0], signatures[-1]) < 0.8
+
+    clusters = app.find_near_duplicate_clusters(signatures, threshold=0.8)
+    for cluster in clusters:
+        representative, members = cluster['members'][0], cluster['members'][1:]
+        similarities = [app.signature_similarity(signatures[representative], signatures[member])
+                        for member in members]
+        assert min(similarities) >= 0.8
+        assert cluster['similarity'] == round(min(similarities), 2)
+    assert not any(0 in cluster['members'] and len(signatures) - 1 in cluster['members']
+                   for cluster in clusters)
+
+def test_identical_answers_cluster_together():
+    text = 'The mitochondria is the powerhouse of the cell and produces ATP through respiration.'
+    signatures = [app.minhash_signature(text), app.minhash_signature('Something else entirely about osmosis.'),
+                  app.minhash_signature(text)]
+    assert app.find_near_duplicate_clusters(signatures) == [{'members': [0, 2], 'similarity': 1.0}]
@@ -0,0 +1,55 @@
+import random
+import string
+
+import pytest
+
+app = pytest.importorskip('app')
+
+SHARED_ANSWER = 'Plants convert light energy into chemical energy stored in glucose.'
+
+def test_small_class_keeps_shared_correct_answer():
+    answers = [
+        f'Name: Alice\n{SHARED_ANSWER}',
+        f'Name: Bob\n{SHARED_ANSWER}',
+        'Name: Carol\nPlants make food from sunlight.',
+    ]
+    boilerplate = app.find_boilerplate_lines(answers)
+    assert boilerplate == set()
+
+    prompt, _ = app.build_grading_prompt('What is photosynthesis?', 'What is photosynthesis?',
+                                         answers[0], boilerplate)
+    assert SHARED_ANSWER in prompt
+
+def test_lines_from_the_reference_are_never_boilerplate():
+    question = f'Explain photosynthesis.\nModel answer: {SHARED_ANSWER}'
+    answers = [f'Class 7B worksheet\nName: Student {i}\n{SHARED_ANSWER}' for i in range(10)]
+    boilerplate = app.find_boilerplate_lines(answers, reference_texts=[question])
+    assert 'class 7b worksheet' in boilerplate
+    assert SHARED_ANSWER.lower() not in boilerplate
+
+def test_truncation_respects_budget():
+    answer = '\n'.join(f'Line {i} of a very long answer about photosynthesis.' for i in range(500))
+    prompt, stats = app.build_grading_prompt('Question?', 'Reference.', answer, token_budget=400)
+    assert stats['truncated']
+    assert stats['tokens_after'] <= 400
+    assert 'lines omitted' in prompt
+
+def fuzz_text(rng, lines, per_line):
+    """Random lines of short words, long words and stray punctuation"""
+    def word():
+        roll = rng.random()
+        if roll < 0.2:
+            return ''.join(rng.choice(string.ascii_letters) for _ in range(rng.randint(10, 40)))
+        if roll < 0.3:
+            return rng.choice('.,;:!?()-')
+        return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 8)))
+    return '\n'.join(' '.join(word() for _ in range(rng.randint(0, per_line))) for _ in range(lines))
+
+def test_budget_is_a_hard_limit():
+    # Seeded so it includes shapes that used to come out one token over
+    rng = random.Random(3)
+    for _ in range(300):
+        parts = fuzz_text(rng, 10, 20), fuzz_text(rng, 10, 20), fuzz_text(rng, 80, 20)
+        budget = rng.choice([200, 300, 500])
+        prompt, stats = app.build_grading_prompt(*parts, token_budget=budget)
+        assert stats['tokens_after'] == app.estimate_tokens(prompt) <= budget
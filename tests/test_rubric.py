@@ -0,0 +1,23 @@
+import pytest
+
+app = pytest.importorskip('app')
+
+def test_weights_are_optional():
+    points = app.parse_rubric('# weight | key phrase | synonyms...\n3 | machine learning | ML\nfraud detection\n0.5 | overfitting')
+    assert points == [
+        {'point': 'machine learning', 'weight': 3.0, 'phrases': ['machine learning', 'ML']},
+        {'point': 'fraud detection', 'weight': 1.0, 'phrases': ['fraud detection']},
+        {'point': 'overfitting', 'weight': 0.5, 'phrases': ['overfitting']},
+    ]
+
+def test_only_plain_numbers_are_weights():
+    points = app.parse_rubric('Infinity | unbounded growth\nnan | not a number\n1e3 | scientific notation')
+    assert [point['phrases'] for point in points] == [
+        ['Infinity', 'unbounded growth'], ['nan', 'not a number'], ['1e3', 'scientific notation']]
+    assert all(point['weight'] == 1.0 for point in points)
+
+@pytest.mark.parametrize('line', ['0 | photosynthesis', '-2 | photosynthesis', '0.0 | photosynthesis',
+                                  '9' * 400 + ' | photosynthesis'])
+def test_non_positive_weights_are_rejected(line):
+    with pytest.raises(ValueError, match='positive number'):
+        app.parse_rubric(line)
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+app = pytest.importorskip('app')
+
+def run_in_order(scheduler, batches):
+    """Queue batches of (tenant, lane, label) behind a blocked worker and return the order they ran in"""
+    order = []
+    started, gate = threading.Event(), threading.Event()
+
+    def block():
+        started.set()
+        gate.wait()
+
+    blocker = scheduler.submit('blocker', 'bulk', block)
+    started.wait(timeout=5)
+    futures = []
+    for tenant, lane, labels in batches:
+        futures += scheduler.submit_many(tenant, lane, order.append, [(label,) for label in labels])
+    gate.set()
+    blocker.result(timeout=5)
+    for future in futures:
+        future.result(timeout=5)
+    return order
+
+def test_interactive_lane_gets_its_weighted_share():
+    scheduler = app.FairScheduler(1, 100, 100)
+    order = run_in_order(scheduler, [('a', 'bulk', ['b'] * 10), ('a', 'interactive', ['i'] * 10)])
+    first = order[:10]
+    assert first.count('i') == 8
+    assert first.count('b') == 2
+    assert sorted(order) == ['b'] * 10 + ['i'] * 10
+
+def test_tenants_share_a_lane_by_weight(monkeypatch):
+    monkeypatch.setattr(app, 'TENANT_WEIGHTS', {'big': 3.0})
+    scheduler = app.FairScheduler(1, 100, 100)
+    order = run_in_order(scheduler, [('big', 'bulk', ['big'] * 12), ('small', 'bulk', ['small'] * 12)])
+    first = order[:8]
+    assert first.count('big') == 6
+    assert first.count('small') == 2
+
+def test_admission_is_all_or_nothing():
+    scheduler = app.FairScheduler(1, 5, 3)
+    with pytest.raises(app.SchedulerFull):
+        scheduler.submit_many('a', 'bulk', print, [()] * 4)
+    assert scheduler.queued == 0
+    assert scheduler.unreserved == 0
+    assert scheduler.tenant_unreserved == {}
+
+    reservation = scheduler.reserve('a', 3)
+    with pytest.raises(app.SchedulerFull):
+        scheduler.reserve('a', 1)
+    scheduler.reserve('b', 2)
+    with pytest.raises(app.SchedulerFull):
+        scheduler.reserve('c', 1)
+    assert scheduler.reserved == 5
+    assert scheduler.tenant_reserved == {'a': 3, 'b': 2}
+    scheduler.release(reservation)
+    assert scheduler.tenant_reserved == {'b': 2}
+
+def test_reservation_is_released_when_a_task_raises():
+    scheduler = app.FairScheduler(2, 10, 10)
+
+    def grade(value):
+        if value == 2:
+            raise ValueError('unreadable answer')
+        return value
+
+    with pytest.raises(ValueError):
+        with scheduler.reserve('a', 3) as reservation:
+            extractions = scheduler.submit_many('a', 'interactive', grade, [(1,), (3,)], reservation)
+            assert [future.result(timeout=5) for future in extractions] == [1, 3]
+            # A stage larger than the reservation is admitted for the difference
+            gradings = scheduler.submit_many('a', 'interactive', grade, [(1,), (2,), (3,), (4,)], reservation)
+            assert scheduler.reserved == 4
+            [future.result(timeout=5) for future in gradings]
+
+    assert reservation.slots == 0
+    assert scheduler.reserved == 0
+    assert scheduler.tenant_reserved == {}
+    assert scheduler.unreserved == 0
+    assert scheduler.queued == 0
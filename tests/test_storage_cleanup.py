@@ -0,0 +1,112 @@
+import io
+import os
+import time
+import uuid
+
+import pytest
+
+app = pytest.importorskip('app')
+
+class Upload:
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    uploads, results, bank = tmp_path / 'uploads', tmp_path / 'results', tmp_path / 'question_bank'
+    for folder in (uploads, results, bank):
+        folder.mkdir()
+    monkeypatch.setattr(app, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setattr(app, 'RESULTS_FOLDER', str(results))
+    monkeypatch.setattr(app, 'BLOB_FOLDER', str(uploads / '_blobs'))
+    monkeypatch.setattr(app, 'QUESTION_BANK_FOLDER', str(bank))
+    monkeypatch.setattr(app, 'MINHASH_INDEX_PATH', str(results / 'minhash_index.jsonl'))
+    monkeypatch.setattr(app, 'MINHASH_INDEX_LOCK_PATH', str(results / 'minhash_index.lock'))
+    monkeypatch.setattr(app, 'reference_bank', app.ReferenceBank(str(bank)))
+    monkeypatch.setattr(app, 'BLOB_GRACE_SECONDS', 0)
+    monkeypatch.setattr(app, 'UPLOAD_TTL_HOURS', 72)
+    monkeypatch.setattr(app, 'REPORT_TTL_HOURS', 720)
+    monkeypatch.setattr(app, 'STORAGE_QUOTA_MB', 1024)
+    return tmp_path
+
+def make_session(age_hours, files):
+    """Create a session aged age_hours with the given {name: bytes} uploads and a report"""
+    session_id = str(uuid.uuid4())
+    folder = app.session_folder_path(session_id)
+    os.makedirs(folder)
+    for name, data in files.items():
+        app.save_deduplicated(Upload(data), os.path.join(folder, name))
+    state = os.path.join(folder, app.SESSION_STATE_FILE)
+    with open(state, 'w') as f:
+        f.write('{}')
+    report = app.report_path(f'evaluation_report_{session_id}_20260101_000000.xlsx')
+    os.makedirs(os.path.dirname(report), exist_ok=True)
+    with open(report, 'wb') as f:
+        f.write(b'report')
+    then = time.time() - age_hours * 3600
+    for path in (state, report):
+        os.utime(path, (then, then))
+    return session_id, folder, report
+
+def blob_count():
+    return sum(len(names) for _, _, names in os.walk(app.BLOB_FOLDER))
+
+def test_expired_uploads_are_stripped_but_state_and_report_kept(storage):
+    _, folder, report = make_session(100, {'question_paper.pdf': b'question', 'answer_1_alice.txt': b'alice'})
+
+    app.run_storage_cleanup()
+
+    assert sorted(os.listdir(folder)) == [app.SESSION_STATE_FILE]
+    assert os.path.exists(report)
+    assert blob_count() == 0
+
+def test_fresh_sessions_are_left_alone(storage):
+    _, folder, report = make_session(10, {'answer_1_alice.txt': b'alice'})
+
+    app.run_storage_cleanup()
+
+    assert sorted(os.listdir(folder)) == ['answer_1_alice.txt', app.SESSION_STATE_FILE]
+    assert os.path.exists(report)
+    assert blob_count() == 1
+
+def test_expired_reports_evict_the_whole_session(storage):
+    _, folder, report = make_session(800, {'answer_1_alice.txt': b'alice'})
+
+    app.run_storage_cleanup()
+
+    assert not os.path.exists(folder)
+    assert not os.path.exists(report)
+    assert blob_count() == 0
+
+def test_shared_blob_is_kept_until_the_last_link_is_removed(storage):
+    shared = b'the same answer uploaded twice'
+    _, old_folder, _ = make_session(800, {'answer_1_alice.txt': shared})
+    _, new_folder, _ = make_session(10, {'answer_1_bob.txt': shared, 'answer_2_carol.txt': b'carol'})
+    assert blob_count() == 2
+
+    app.run_storage_cleanup()
+
+    assert not os.path.exists(old_folder)
+    assert blob_count() == 2
+    with open(os.path.join(new_folder, 'answer_1_bob.txt'), 'rb') as f:
+        assert f.read() == shared
+
+    for name in ('answer_1_bob.txt', 'answer_2_carol.txt'):
+        os.remove(os.path.join(new_folder, name))
+    app.run_storage_cleanup()
+
+    assert blob_count() == 0
+
+def test_quota_counts_a_shared_blob_once(storage, monkeypatch):
+    shared = b'S' * 200000
+    _, older_folder, _ = make_session(30, {'answer_1_alice.txt': shared})
+    _, newer_folder, _ = make_session(20, {'answer_1_bob.txt': shared})
+    # Both sessions together hold one 200 kB blob, so evicting the older one
+    # frees none of it and the newer one must go as well
+    monkeypatch.setattr(app, 'STORAGE_QUOTA_MB', 0.1)
+
+    app.run_storage_cleanup()
+
+    assert not os.path.exists(older_folder)
+    assert not os.path.exists(newer_folder)
+    assert blob_count() == 0